@@ -20,11 +20,19 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 try:
     from shared.drowsiness_analyzer import DrowsinessAnalyzer
+    from shared.streaming import FRAME_HDR, FRAME_H264, FRAME_REPEAT
     from shared import config
 except ImportError:
     st.error("Error: Could not import 'shared' module.")
     st.stop()
 
+# PyAV decodes the H.264 stream from the Raspberry hardware encoder (optional)
+try:
+    import av
+    HAS_PYAV = True
+except ImportError:
+    HAS_PYAV = False
+
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 5555
 BUFFER_SIZE = 65536
@@ -140,7 +148,8 @@ def _recv_exact(sock, size):
 def tcp_server_loop():
     """
     Receives frames + stats from Raspberry Pi.
-    Protocol: [4 bytes stats_size][JSON stats][4 bytes frame_size][JPEG frame]
+    Protocol: [4 bytes stats_size][JSON stats][1 byte frame_type][4 bytes frame_size][frame]
+    frame_type: JPEG image, H.264 access unit or repeat of the previous JPEG (no payload)
     """
     analyzer = DrowsinessAnalyzer()
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -159,6 +168,9 @@ def tcp_server_loop():
             state.update_rpi_stats(0, 0, 0, 0, addr[0])  # Store client IP
             analyzer.ear_counter = 0
             analyzer.yawn_counter = 0
+            # New decoder per connection: the client restarts the stream at a keyframe
+            h264_decoder = av.CodecContext.create('h264', 'r') if HAS_PYAV else None
+            last_jpeg = None
             
             while True:
                 # 1. Read stats JSON size
@@ -187,28 +199,50 @@ def tcp_server_loop():
                     except:
                         pass  # Keep old stats
                 
-                # 3. Read frame size
-                frame_size_data = _recv_exact(client_socket, 4)
-                if not frame_size_data:
+                # 3. Read frame type + size
+                frame_hdr_data = _recv_exact(client_socket, FRAME_HDR.size)
+                if not frame_hdr_data:
                     raise ConnectionError("Client disconnected")
-                frame_size = struct.unpack('>I', frame_size_data)[0]
+                frame_type, frame_size = FRAME_HDR.unpack(frame_hdr_data)
                 
                 # 4. Read frame data
-                frame_data = _recv_exact(client_socket, frame_size)
-                if not frame_data:
+                frame_data = _recv_exact(client_socket, frame_size) if frame_size else b''
+                if frame_data is None:
                     raise ConnectionError("Incomplete frame")
                 
-                frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), cv2.IMREAD_COLOR)
-                if frame is None:
-                    continue
+                if frame_type == FRAME_REPEAT:
+                    # Client skipped a near-duplicate frame: analyze the previous one again
+                    # so the consecutive-frame counters keep ticking at camera rate
+                    if last_jpeg is None:
+                        continue
+                    frame_data, frame_type = last_jpeg, None
+                elif frame_type != FRAME_H264:
+                    last_jpeg = frame_data
                 
-                # Process with MediaPipe
-                processed, ear, mar, is_drowsy, is_yawning, face_detected, _ = analyzer.detect(frame)
+                if frame_type == FRAME_H264:
+                    if h264_decoder is None:
+                        raise ConnectionError("H.264 stream received but PyAV is not installed")
+                    frames = [f.to_ndarray(format='bgr24')
+                              for packet in h264_decoder.parse(frame_data)
+                              for f in h264_decoder.decode(packet)]
+                else:
+                    frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    frames = [frame] if frame is not None else []
                 
-                # Prepare preview
-                preview = cv2.resize(processed, (320, 240))
-                
-                state.update(ear, mar, is_drowsy, is_yawning, face_detected, preview)
+                for frame in frames:
+                    # Small streamed frames (SEND_WIDTH x SEND_HEIGHT, --detect-size) back to the
+                    # camera size: the overlay positions and text scale are laid out for it
+                    if frame.shape[1] != config.CAMERA_WIDTH or frame.shape[0] != config.CAMERA_HEIGHT:
+                        frame = cv2.resize(frame, (config.CAMERA_WIDTH, config.CAMERA_HEIGHT),
+                                           interpolation=cv2.INTER_LINEAR)
+
+                    # Process with MediaPipe
+                    processed, ear, mar, is_drowsy, is_yawning, face_detected, _ = analyzer.detect(frame)
+                    
+                    # Prepare preview
+                    preview = processed if processed.shape[:2] == (240, 320) else cv2.resize(processed, (320, 240))
+                    
+                    state.update(ear, mar, is_drowsy, is_yawning, face_detected, preview)
                 
         except Exception as e:
             print(f"[SERVER] Error: {e}")
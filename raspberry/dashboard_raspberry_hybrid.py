@@ -11,10 +11,14 @@ os.environ['GLOG_minloglevel'] = '3'
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
 os.environ["GLOG_logtostderr"] = '0'
 os.environ['MAGLEV_HTTP_RESOLVER'] = '0'
+# One thread per native library: parallelism comes from the capture/encode/detect pipeline,
+# a thread pool per call costs more than the work itself on small frames
+os.environ["OMP_NUM_THREADS"] = '1'
+os.environ["OPENBLAS_NUM_THREADS"] = '1'
 
-import socket
-import struct
 import cv2
+cv2.setNumThreads(1)
+cv2.ocl.setUseOpenCL(False)
 import time
 import psutil
 import json
@@ -30,17 +34,17 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 try:
     from shared.drowsiness_analyzer import DrowsinessAnalyzer
+    from shared.streaming import (JpegEncoder, FrameSender, FramePipeline, CameraFrameRing,
+                                  start_hw_encoder, DuplicateFrameFilter, start_connect, poll_connect,
+                                  FRAME_JPEG, FRAME_REPEAT)
     from shared import config
 except ImportError:
     st.error("Error: Could not import 'shared' module.")
     st.stop()
 
-# Try to import Raspberry Pi specific modules
-try:
-    from gpiozero import CPUTemperature
-    HAS_GPIOZERO = True
-except ImportError:
-    HAS_GPIOZERO = False
+# CPU temperature in millidegrees (what gpiozero's CPUTemperature reads)
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+HAS_CPU_TEMP = os.path.exists(CPU_TEMP_PATH)
 
 st.set_page_config(page_title="Drowsiness - Raspberry Standalone", page_icon="🍓", layout="wide")
 
@@ -188,12 +192,20 @@ class HybridClient:
         self.state = shared_state
         self.server_ip = config.PC_SERVER_IP
         self.server_port = config.PC_SERVER_PORT
+        self.codec = config.STREAM_CODEC
         self.socket = None
+        self._pending_socket = None  # Connection attempt in progress (non-blocking)
+        self.sender = None
         self.connected = False
         
         # Camera
         self.camera = None
         self.use_picamera2 = False
+        self.frame_ring = None  # Preallocated PiCamera2 frames (see CameraFrameRing)
+        self.encoder = JpegEncoder()
+        self.send_size = (config.SEND_WIDTH, config.SEND_HEIGHT)
+        self.dedup = DuplicateFrameFilter() if config.SKIP_DUPLICATE_FRAMES else None
+        self.hw_stream = None  # Hardware encoder output (PiCamera2 + "h264"/"mjpeg" codec only)
         
         # Analyzer
         self.analyzer = None
@@ -202,31 +214,62 @@ class HybridClient:
         self.frame_count = 0
         self.start_time = time.time()
         self.running = True
+
+        # Kept open: the temperature is re-read with pread() instead of reopening sysfs
+        try:
+            self._cpu_temp_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+        except OSError:
+            self._cpu_temp_fd = None
+        psutil.cpu_percent(interval=None)  # First call only sets the baseline (always 0.0)
         
 
 
     def get_system_stats(self):
         try:
-            cpu_temp = CPUTemperature().temperature if HAS_GPIOZERO else 0.0
-            cpu_usage = psutil.cpu_percent(percpu=True)
-            cpu_usage = sum(cpu_usage)  # Sum of all cores
+            cpu_temp = 0.0
+            if self._cpu_temp_fd is not None:
+                cpu_temp = int(os.pread(self._cpu_temp_fd, 16, 0)) / 1000.0
+            cpu_usage = psutil.cpu_percent(interval=None)  # Average of all cores (0-100%)
             ram = psutil.virtual_memory().percent
             return cpu_temp, cpu_usage, ram
         except:
             return 0.0, 0.0, 0.0
 
     def connect_to_server(self):
-        now = time.time()
-        if now - self.last_reconnect_attempt < self.reconnect_interval:
+        """
+        Non-blocking: starts a connection attempt every reconnect_interval and checks it
+        on the following calls, so capture and standalone detection never stall.
+        """
+        if self._pending_socket is None:
+            now = time.time()
+            if now - self.last_reconnect_attempt < self.reconnect_interval:
+                return False
+            self.last_reconnect_attempt = now
+            try:
+                self._pending_socket = start_connect((self.server_ip, self.server_port))
+            except OSError:
+                return False
+
+        try:
+            if not poll_connect(self._pending_socket):
+                # Still in progress: give up after 1 second, retry at the next interval
+                if time.time() - self.last_reconnect_attempt > 1.0:
+                    self._pending_socket.close()
+                    self._pending_socket = None
+                return False
+        except OSError:
+            self._pending_socket.close()
+            self._pending_socket = None
             return False
-        
-        self.last_reconnect_attempt = now
+
+        self.socket, self._pending_socket = self._pending_socket, None
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(1.0)
-            self.socket.connect((self.server_ip, self.server_port))
-            self.socket.settimeout(None)
+            self.sender = FrameSender(self.socket)
+            if self.dedup is not None:
+                self.dedup.reset()  # The server has no previous frame for a FRAME_REPEAT yet
             self.connected = True
+            if self.hw_stream:
+                self.hw_stream.active = True
             self.state.set_mode(connected_to_server=True, standalone_active=False)
             self.start_time = time.time()
             self.frame_count = 0
@@ -234,6 +277,7 @@ class HybridClient:
             return True
         except:
             self.connected = False
+            self.socket.close()
             return False
 
     def init_camera(self):
@@ -242,16 +286,25 @@ class HybridClient:
             from picamera2 import Picamera2
             self.camera = Picamera2()
             cam_config = self.camera.create_video_configuration(
+                # libcamera naming: "RGB888" = BGR byte order (OpenCV-ready)
                 main={"size": (config.CAMERA_WIDTH, config.CAMERA_HEIGHT), "format": "RGB888"},
                 controls={"FrameRate": config.CAMERA_FPS}
             )
             self.camera.configure(cam_config)
             self.camera.start()
+            self.frame_ring = CameraFrameRing(self.camera)
             self.use_picamera2 = True
             print("[INFO] PiCamera2 active")
+            if self.codec in ("h264", "mjpeg"):
+                try:
+                    self.hw_stream = start_hw_encoder(self.camera, self.codec)
+                    print(f"[INFO] Hardware {self.codec.upper()} encoder active")
+                except Exception as e:
+                    print(f"[WARN] {self.codec.upper()} encoder not available ({e}), using JPEG")
             return True
         except:
             self.camera = cv2.VideoCapture(0)
+            self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # No stale frames queued in the driver
             self.camera.set(3, config.CAMERA_WIDTH)
             self.camera.set(4, config.CAMERA_HEIGHT)
             print("[INFO] USB Webcam active")
@@ -259,14 +312,28 @@ class HybridClient:
 
     def capture_frame(self):
         if self.use_picamera2:
-            return cv2.cvtColor(self.camera.capture_array(), cv2.COLOR_RGB2BGR)
+            # Picamera2 "RGB888" is already stored as [B, G, R]: no conversion needed
+            return self.frame_ring.capture()
         ret, frame = self.camera.read()
         return frame if ret else None
 
-    def send_frame_with_stats(self, frame, send_stats=False):
+    def release_frame(self, frame):
+        """Hands a captured frame back to the camera ring once nothing uses it anymore"""
+        if self.frame_ring is not None:
+            self.frame_ring.release(frame)
+
+    def encode_frame(self, frame):
+        """Encode stage: (FRAME_REPEAT, b'') for near-duplicate frames, (FRAME_JPEG, jpeg) otherwise"""
+        if self.dedup is not None and self.dedup.is_duplicate(frame):
+            return FRAME_REPEAT, b''
+        if (frame.shape[1], frame.shape[0]) != self.send_size:
+            frame = cv2.resize(frame, self.send_size, interpolation=cv2.INTER_AREA)
+        return FRAME_JPEG, self.encoder.encode(frame)
+
+    def send_frame_with_stats(self, frame_data, send_stats=False, frame_type=FRAME_JPEG):
         """
-        Send frame + system stats to server.
-        Protocol: [4 bytes stats_size][JSON stats][4 bytes frame_size][JPEG frame]
+        Send encoded frame + system stats to server.
+        Protocol: [4 bytes stats_size][JSON stats][1 byte frame_type][4 bytes frame_size][frame]
         Se send_stats=False, invia solo il frame (stats_size=0)
         """
         try:
@@ -286,17 +353,13 @@ class HybridClient:
             else:
                 # No stats - send empty JSON
                 stats_json = b'{}'
-            # Encode frame
-            _, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, config.JPEG_QUALITY])
-            frame_data = encoded.tobytes()
-            # Send: stats_size + stats + frame_size + frame
-            self.socket.sendall(struct.pack('>I', len(stats_json)))
-            self.socket.sendall(stats_json)
-            self.socket.sendall(struct.pack('>I', len(frame_data)))
-            self.socket.sendall(frame_data)
+            # Send: stats_size + stats + frame_type/frame_size + frame
+            self.sender.send(stats_json, frame_data, frame_type)
             return True
         except:
             self.connected = False
+            if self.hw_stream:
+                self.hw_stream.active = False
             if self.socket:
                 self.socket.close()
             self.state.set_mode(connected_to_server=False, standalone_active=True)
@@ -314,6 +377,7 @@ class HybridClient:
             if frame is not None:
                 processed, _, _, _, _, _, _ = self.analyzer.detect(frame)
                 preview = cv2.resize(processed, (320, 240))
+                self.release_frame(frame)
                 self.state.update_calibration(i, f"Starting in {i}s - position yourself...", preview)
             time.sleep(1)
         
@@ -333,6 +397,7 @@ class HybridClient:
             # Process frame to get EAR
             processed, ear, mar, _, _, face_detected, _ = self.analyzer.detect(frame)
             preview = cv2.resize(processed, (320, 240))
+            self.release_frame(frame)
             
             remaining = calibration_duration - int(elapsed)
             
@@ -373,6 +438,7 @@ class HybridClient:
         dummy_frame = self.capture_frame()
         if dummy_frame is not None:
             self.analyzer.detect(dummy_frame)
+            self.release_frame(dummy_frame)
 
         # Check for existing calibration or run automatic calibration
         if os.path.exists(self.analyzer.config_path):
@@ -387,9 +453,15 @@ class HybridClient:
         self.state.set_mode(connected_to_server=False, standalone_active=True)
         self.state.reset_for_standalone()
 
+        # Capture and JPEG encoding run on their own threads (encode only in CLIENT mode)
+        pipeline = FramePipeline(self.capture_frame, self.encode_frame,
+                                 lambda: self.connected and self.hw_stream is None,
+                                 release=self.release_frame)
+        pipeline.start()
+
         try:
             while self.running:
-                frame = self.capture_frame()
+                frame, encoded = pipeline.get()
                 if frame is None:
                     continue
 
@@ -403,11 +475,22 @@ class HybridClient:
                 if self.connected:
                     # CLIENT MODE - Send frame + stats to PC server
                     send_stats = (self.frame_count % config.CAMERA_FPS == 0)
-                    if not self.send_frame_with_stats(frame, send_stats):
-                        # Connection lost, will switch back to standalone
-                        self.state.reset_for_standalone()
-                        self.frame_count = 0
-                        self.start_time = time.time()
+                    if self.hw_stream:
+                        # Hardware encoder output (the captured frame is only used in standalone)
+                        packets = [(self.hw_stream.frame_type, chunk) for chunk in self.hw_stream.drain()]
+                    else:
+                        if encoded is None:
+                            # Frame captured before the connection was up
+                            encoded = self.encode_frame(frame)
+                        packets = [encoded]
+                    for frame_type, data in packets:
+                        if not self.send_frame_with_stats(data, send_stats, frame_type):
+                            # Connection lost, will switch back to standalone
+                            self.state.reset_for_standalone()
+                            self.frame_count = 0
+                            self.start_time = time.time()
+                            break
+                        send_stats = False
                 else:
                     # STANDALONE MODE - Process locally and update dashboard
                     processed, ear, mar, drowsy, yawn, face, _ = self.analyzer.detect(frame)
@@ -417,6 +500,9 @@ class HybridClient:
                     
                     self.state.update(ear, mar, drowsy, yawn, face, preview)
 
+                # Sent or drawn into the preview copy: the ring slot can be reused
+                self.release_frame(frame)
+
                 # Update system stats periodically
                 if self.frame_count % config.CAMERA_FPS == 0:
                     elapsed = time.time() - self.start_time
@@ -427,13 +513,18 @@ class HybridClient:
         except Exception as e:
             print(f"[ERROR] {e}")
         finally:
+            pipeline.stop()
             self.cleanup()
 
     def cleanup(self):
         self.running = False
+        if self._pending_socket:
+            self._pending_socket.close()
         if self.socket:
             self.socket.close()
         if self.use_picamera2 and self.camera:
+            if self.hw_stream:
+                self.camera.stop_encoder()
             self.camera.stop()
         elif self.camera:
             self.camera.release()
@@ -568,7 +659,7 @@ try:
                 s1.metric("FPS", f"{snap['fps']:.1f}")
                 s2.metric("CPU", f"{snap['cpu_usage']:.1f}%")
                 s3.metric("RAM", f"{snap['ram_usage']:.1f}%")
-                if HAS_GPIOZERO:
+                if HAS_CPU_TEMP:
                     s4.metric("Temp", f"{snap['cpu_temp']:.1f}°C")
                 else:
                     s4.metric("Temp", "N/A")
@@ -2,14 +2,22 @@
 import os
 # Suppress MediaPipe/TF Lite logging (only show errors)
 os.environ['GLOG_minloglevel'] = '2'
+# One thread per native library: parallelism comes from the capture/encode/detect pipeline,
+# a thread pool per call costs more than the work itself on small frames
+os.environ["OMP_NUM_THREADS"] = '1'
+os.environ["OPENBLAS_NUM_THREADS"] = '1'
 
-import socket
-import struct
+import argparse
 import cv2
+cv2.setNumThreads(1)
+cv2.ocl.setUseOpenCL(False)
+import numpy as np
 import time
 import psutil
 import json
-from gpiozero import CPUTemperature
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 import sys
 import pandas as pd
@@ -23,22 +31,57 @@ os.environ['MAGLEV_HTTP_RESOLVER'] = '0'
 # Add parent directory to path to import shared modules
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from shared import config
+from shared.detector_process import DetectorProcess
+from shared.streaming import (JpegEncoder, FrameSender, FramePipeline, CameraFrameRing,
+                              start_hw_encoder, DuplicateFrameFilter, pin_thread, start_connect,
+                              poll_connect, FRAME_JPEG, FRAME_REPEAT)
 try:
     from shared.drowsiness_analyzer import DrowsinessAnalyzer
 except ImportError:
     print("[ERROR] DrowsinessAnalyzer not found!")
 
+# CPU temperature in millidegrees (what gpiozero's CPUTemperature reads)
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+# Main loop messages: the loop only queues them, a listener thread writes to stdout
+# (on a headless Pi stdout is a serial console/journald and a print can block for tens of ms)
+log = logging.getLogger("raspberry_client")
+log.propagate = False
+
+def start_log_listener():
+    """Attaches a QueueHandler to the client logger and starts the thread that prints the records"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+    log.handlers[:] = [QueueHandler(log_queue)]
+    log.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
 class SmartRaspberryClient:
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, codec=config.STREAM_CODEC, frame_size=None):
         self.log_history = []
         self.server_ip = server_ip
         self.server_port = server_port
+        self.codec = codec
+        # Size of the frames fed to the detector/encoder (--detect-size), camera size by default
+        self.frame_width, self.frame_height = frame_size or (config.CAMERA_WIDTH, config.CAMERA_HEIGHT)
         self.socket = None
+        self._pending_socket = None  # Connection attempt in progress (non-blocking)
+        self.sender = None
         self.connected = False
         
         # Camera
         self.camera = None
         self.use_picamera2 = False
+        self.frame_ring = None  # Preallocated PiCamera2 frames (see CameraFrameRing)
+        self.encoder = JpegEncoder()
+        # Streamed JPEG size: --detect-size frames are sent as they come from the ISP (no CPU
+        # resize), camera-size frames are downscaled to SEND_WIDTHxSEND_HEIGHT before encoding
+        self.send_size = frame_size or (config.SEND_WIDTH, config.SEND_HEIGHT)
+        self.dedup = DuplicateFrameFilter() if config.SKIP_DUPLICATE_FRAMES else None
+        self.hw_stream = None  # Hardware encoder output (PiCamera2 + "h264"/"mjpeg" codec only)
         
         # Analyzer & Stats
         self.local_detector = None
@@ -46,6 +89,13 @@ class SmartRaspberryClient:
         self.reconnect_interval = 5
         self.frame_count = 0
         self.start_time = time.time()
+
+        # Kept open: the temperature is re-read with pread() instead of reopening sysfs
+        try:
+            self._cpu_temp_fd = os.open(CPU_TEMP_PATH, os.O_RDONLY)
+        except OSError:
+            self._cpu_temp_fd = None
+        psutil.cpu_percent(interval=None)  # First call only sets the baseline (always 0.0)
         
     def run_calibration(self, analyzer):
         """10-second initial setup to personalize EAR threshold"""
@@ -67,36 +117,50 @@ class SmartRaspberryClient:
         print("[ACTION] Keep your eyes naturally open for 10 seconds.")
         time.sleep(2)
         
-        ear_values = []
-        start_time = time.time()
         calibration_duration = 10 # Secondi richiesti
+        # EAR samples in a preallocated buffer (2x margin on the camera FPS), mean in one pass at the end
+        ear_buf = np.empty(calibration_duration * config.CAMERA_FPS * 2, dtype=np.float32)
+        n_samples = 0
+        last_printed_sec = -1
+        # Bound methods hoisted out of the loop
+        detect = analyzer.detect
+        capture = self.capture_frame
+        release = self.release_frame
+        now = time.monotonic
+        start_time = now()
         
         while True:
-            elapsed = time.time() - start_time
+            elapsed = now() - start_time
             if elapsed >= calibration_duration:
                 break # Calibrazione completata con successo
                 
-            frame = self.capture_frame()
+            frame = capture()
             if frame is not None:
-                # Riceve i 6 valori dall'analyzer aggiornato
-                _, ear, _, _, _, face_detected = analyzer.detect(frame)
+                # Riceve i 7 valori dall'analyzer aggiornato
+                _, ear, _, _, _, face_detected, _ = detect(frame)
+                release(frame)
                 
                 if face_detected:
-                    if ear > 0.1:
-                        ear_values.append(ear)
+                    if ear > 0.1 and n_samples < len(ear_buf):
+                        ear_buf[n_samples] = ear
+                        n_samples += 1
                     
-                    remaining = calibration_duration - int(elapsed)
-                    print(f"Calibrating... {remaining}s remaining | Current EAR: {ear:.2f}      ", end="\r")
+                    # Progress line once per second (console output is slow on the Pi)
+                    if int(elapsed) != last_printed_sec:
+                        last_printed_sec = int(elapsed)
+                        remaining = calibration_duration - last_printed_sec
+                        print(f"Calibrating... {remaining}s remaining | Current EAR: {ear:.2f}      ", end="\r")
                 else:
                     # RESET: Se il viso viene perso, resetta timer e campioni
                     if elapsed > 0.5: # Evita reset per micro-glitch istantanei
                         print("\n[⚠️ RESET] Face lost! Restarting 10s timer...          ")
-                        ear_values = []
-                        start_time = time.time()
+                        n_samples = 0
+                        last_printed_sec = -1
                         time.sleep(1) # Breve pausa per permettere all'utente di posizionarsi
+                        start_time = now()
         
-        if len(ear_values) > 0:
-            avg_ear = sum(ear_values) / len(ear_values)
+        if n_samples > 0:
+            avg_ear = float(ear_buf[:n_samples].mean())
             # Threshold set at 85% of average open-eye EAR
             new_threshold = avg_ear * 0.85
             analyzer.save_threshold(new_threshold)
@@ -109,33 +173,58 @@ class SmartRaspberryClient:
 
     def get_system_stats(self):
         try:
-            cpu_temp = CPUTemperature().temperature
-            cpu_usage = psutil.cpu_percent(percpu=True)
-            cpu_usage = sum(cpu_usage)  # Sum of all cores
+            cpu_temp = 0.0
+            if self._cpu_temp_fd is not None:
+                cpu_temp = int(os.pread(self._cpu_temp_fd, 16, 0)) / 1000.0
+            cpu_usage = psutil.cpu_percent(interval=None)  # Average of all cores (0-100%)
             ram = psutil.virtual_memory().percent
             return cpu_temp, cpu_usage, ram
         except:
             return 0.0, 0.0, 0.0
 
     def connect_to_server(self):
-        now = time.time()
-        if now - self.last_reconnect_attempt < self.reconnect_interval:
+        """
+        Non-blocking: starts a connection attempt every reconnect_interval and checks it
+        on the following calls, so capture and standalone detection never stall.
+        """
+        if self._pending_socket is None:
+            now = time.time()
+            if now - self.last_reconnect_attempt < self.reconnect_interval:
+                return False
+            self.last_reconnect_attempt = now
+            try:
+                self._pending_socket = start_connect((self.server_ip, self.server_port))
+            except OSError:
+                return False
+
+        try:
+            if not poll_connect(self._pending_socket):
+                # Still in progress: give up after 1 second, retry at the next interval
+                if time.time() - self.last_reconnect_attempt > 1.0:
+                    self._pending_socket.close()
+                    self._pending_socket = None
+                return False
+        except OSError:
+            self._pending_socket.close()
+            self._pending_socket = None
             return False
-        
-        self.last_reconnect_attempt = now
+
+        self.socket, self._pending_socket = self._pending_socket, None
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(1.0)
-            self.socket.connect((self.server_ip, self.server_port))
-            self.socket.settimeout(None)
+            self.sender = FrameSender(self.socket)
+            if self.dedup is not None:
+                self.dedup.reset()  # The server has no previous frame for a FRAME_REPEAT yet
             self.connected = True
-            print(f"\n[CONNECTED] Server found! Switching to CLIENT mode.")
+            if self.hw_stream:
+                self.hw_stream.active = True
+            log.info("\n[CONNECTED] Server found! Switching to CLIENT mode.")
             self.local_detector = None 
             self.start_time = time.time() # Reset FPS timer
             self.frame_count = 0
             return True
         except:
             self.connected = False
+            self.socket.close()
             return False
 
     def init_camera(self):
@@ -144,31 +233,61 @@ class SmartRaspberryClient:
             from picamera2 import Picamera2
             self.camera = Picamera2()
             cam_config = self.camera.create_video_configuration(
-                main={"size": (config.CAMERA_WIDTH, config.CAMERA_HEIGHT), "format": "RGB888"},
+                # libcamera naming: "RGB888" = BGR byte order (OpenCV-ready)
+                # The ISP scales to this size in hardware: no CPU resize on this path
+                main={"size": (self.frame_width, self.frame_height), "format": "RGB888"},
                 controls={"FrameRate": config.CAMERA_FPS}
             )
             self.camera.configure(cam_config)
             self.camera.start()
+            self.frame_ring = CameraFrameRing(self.camera)
             self.use_picamera2 = True
             print("[INFO] PiCamera2 active")
+            if self.codec in ("h264", "mjpeg"):
+                try:
+                    self.hw_stream = start_hw_encoder(self.camera, self.codec)
+                    print(f"[INFO] Hardware {self.codec.upper()} encoder active")
+                except Exception as e:
+                    print(f"[WARN] {self.codec.upper()} encoder not available ({e}), using JPEG")
             return True
         except:
             self.camera = cv2.VideoCapture(0)
-            self.camera.set(3, config.CAMERA_WIDTH)
-            self.camera.set(4, config.CAMERA_HEIGHT)
+            self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # No stale frames queued in the driver
+            self.camera.set(3, self.frame_width)
+            self.camera.set(4, self.frame_height)
             print("[INFO] USB Webcam active")
             return self.camera.isOpened()
 
     def capture_frame(self):
         if self.use_picamera2:
-            return cv2.cvtColor(self.camera.capture_array(), cv2.COLOR_RGB2BGR)
+            # Picamera2 "RGB888" is already stored as [B, G, R]: no conversion needed
+            return self.frame_ring.capture()
         ret, frame = self.camera.read()
-        return frame if ret else None
+        if not ret:
+            return None
+        if frame.shape[1] != self.frame_width or frame.shape[0] != self.frame_height:
+            # Webcam doesn't support the requested size: downscale once, before encode/detect
+            frame = cv2.resize(frame, (self.frame_width, self.frame_height), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def release_frame(self, frame):
+        """Hands a captured frame back to the camera ring once nothing uses it anymore"""
+        if self.frame_ring is not None:
+            self.frame_ring.release(frame)
 
-    def send_frame_with_stats(self, frame, send_stats=False):
+    def encode_frame(self, frame):
+        """Encode stage: (FRAME_REPEAT, b'') for near-duplicate frames, (FRAME_JPEG, jpeg) otherwise"""
+        if self.dedup is not None and self.dedup.is_duplicate(frame):
+            return FRAME_REPEAT, b''
+        # Only without --detect-size: the frame already has the send size otherwise
+        if (frame.shape[1], frame.shape[0]) != self.send_size:
+            frame = cv2.resize(frame, self.send_size, interpolation=cv2.INTER_AREA)
+        return FRAME_JPEG, self.encoder.encode(frame)
+
+    def send_frame_with_stats(self, frame_data, send_stats=False, frame_type=FRAME_JPEG):
         """
-        Send frame + system stats to server.
-        Protocol: [4 bytes stats_size][JSON stats][4 bytes frame_size][JPEG frame]
+        Send encoded frame + system stats to server.
+        Protocol: [4 bytes stats_size][JSON stats][1 byte frame_type][4 bytes frame_size][frame]
         Se send_stats=False, invia solo il frame (stats_size=0)
         """
         try:
@@ -188,17 +307,13 @@ class SmartRaspberryClient:
             else:
                 # No stats - send empty JSON
                 stats_json = b'{}'
-            # Encode frame
-            _, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, config.JPEG_QUALITY])
-            frame_data = encoded.tobytes()
-            # Send: stats_size + stats + frame_size + frame
-            self.socket.sendall(struct.pack('>I', len(stats_json)))
-            self.socket.sendall(stats_json)
-            self.socket.sendall(struct.pack('>I', len(frame_data)))
-            self.socket.sendall(frame_data)
+            # Send: stats_size + stats + frame_type/frame_size + frame
+            self.sender.send(stats_json, frame_data, frame_type)
             return True
         except:
             self.connected = False
+            if self.hw_stream:
+                self.hw_stream.active = False
             if self.socket:
                 self.socket.close()
             return False
@@ -232,31 +347,68 @@ class SmartRaspberryClient:
     def run(self):
         if not self.init_camera(): return
         
-        print("[SYSTEM] Starting MediaPipe engine...")
-        startup_analyzer = DrowsinessAnalyzer()
+        # Standalone MediaPipe in a worker process on its own core, started right away:
+        # its model load overlaps warm-up and calibration instead of stalling the first frames
+        detector = DetectorProcess(self.frame_width, self.frame_height)
+        detector.start()
 
-        # --- WARM-UP STEP ---
-        # Catturiamo un frame e lo processiamo subito per far uscire i warning di MediaPipe/TFLite
-        print("[SYSTEM] Warming up landmarks engine...")
-        dummy_frame = self.capture_frame()
-        if dummy_frame is not None:
-            startup_analyzer.detect(dummy_frame) # Questo scatena i warning
+        try:
+            print("[SYSTEM] Starting MediaPipe engine...")
+            startup_analyzer = DrowsinessAnalyzer(draw=False)  # Warm-up/calibration: frames are never shown
 
-        # START CALIBRATION BEFORE THE MAIN LOOP
-        self.run_calibration(startup_analyzer)
+            # --- WARM-UP STEP ---
+            # Catturiamo un frame e lo processiamo subito per far uscire i warning di MediaPipe/TFLite
+            print("[SYSTEM] Warming up landmarks engine...")
+            dummy_frame = self.capture_frame()
+            if dummy_frame is not None:
+                startup_analyzer.detect(dummy_frame) # Questo scatena i warning
+                self.release_frame(dummy_frame)
 
-        print("="*60)
-        print(" DROWSINESS DETECTION")
-        print("="*60)
+            # START CALIBRATION BEFORE THE MAIN LOOP
+            self.run_calibration(startup_analyzer)
+        except BaseException:
+            detector.close()
+            raise
+        # The worker loaded the threshold before calibration ended: hand it the final one
+        detector.set_ear_threshold(startup_analyzer.ear_threshold)
+        del startup_analyzer  # Standalone detection runs in the worker process from now on
+
+        log_listener = start_log_listener()
+        log.info("=" * 60)
+        log.info(" DROWSINESS DETECTION")
+        log.info("=" * 60)
+
+        # Capture and JPEG encoding run on their own threads (encode only in CLIENT mode)
+        pipeline = FramePipeline(self.capture_frame, self.encode_frame,
+                                 lambda: self.connected and self.hw_stream is None,
+                                 release=self.release_frame)
+        pipeline.start()
+        # Pin the main (sender) loop only now: threads and processes inherit the affinity mask
+        pin_thread(config.SEND_CPU, config.SENDER_RT_PRIORITY)
+
+        # Last standalone result (the worker answers asynchronously)
+        current_ear, score, status_label = 0.0, 0.0, "OK"
+        # Timestamp strings, formatted once per second for both the CSV and the status line
+        last_sec, csv_ts, clock_ts = -1, "", ""
+
+        def to_comma_str(val):
+            return str(val).replace('.', ',')
+
+        # Hot-loop bindings: locals instead of global/attribute lookups every frame
+        get_frame = pipeline.get
+        encode_frame = self.encode_frame
+        release_frame = self.release_frame
+        send_frame = self.send_frame_with_stats
+        stats_every = config.CAMERA_FPS
+        display = config.DISPLAY_ENABLED
+        imshow, wait_key = cv2.imshow, cv2.waitKey
         
         try:
             while True:
-                frame = self.capture_frame()
+                frame, encoded = get_frame()
                 if frame is None: continue
 
                 self.frame_count += 1
-                current_ear = 0.0
-                status_label = "OK"
 
                 # 1. HANDLING CONNECTION
                 if not self.connected:
@@ -265,39 +417,65 @@ class SmartRaspberryClient:
                 # 2. OPERATIONAL LOGIC
                 if self.connected:
                     mode_label = "CLIENT"
+                    current_ear, status_label = 0.0, "OK"
                     # Send stats only every CAMERA_FPS frames (once per second)
-                    send_stats = (self.frame_count % config.CAMERA_FPS == 0)
-                    if not self.send_frame_with_stats(frame, send_stats):
-                        print("\n[LOST] Connection lost! Loading local analyzer...")
+                    send_stats = (self.frame_count % stats_every == 0)
+                    if self.hw_stream:
+                        # Hardware encoder output (the captured frame is only used in standalone)
+                        packets = [(self.hw_stream.frame_type, chunk) for chunk in self.hw_stream.drain()]
+                    else:
+                        if encoded is None:
+                            # Frame captured before the connection was up
+                            encoded = encode_frame(frame)
+                        packets = [encoded]
+                    for frame_type, data in packets:
+                        if not send_frame(data, send_stats, frame_type):
+                            log.info("\n[LOST] Connection lost! Loading local analyzer...")
+                            break
+                        send_stats = False
                 else:
                     mode_label = "STNDAL" # Standalone
                     if self.local_detector is None:
-                        self.local_detector = startup_analyzer
+                        self.local_detector = detector
                         self.start_time = time.time()
                         self.frame_count = 0
 
-                    processed, ear, mar, drowsy, yawn, face, score = self.local_detector.detect(frame)
-                    current_ear = ear
-                    if not face: status_label = "!!! NO FACE !!!"
-                    elif drowsy: status_label = "DRWS!"
-                    elif yawn: status_label = "YAWN"
-                    else: status_label = "OK"
+                    # Collect the worker's last result, then hand it this frame (skipped if still busy)
+                    result = self.local_detector.poll()
+                    self.local_detector.submit(frame)
+                    if self.local_detector.restarting:
+                        # Worker crashed: don't keep showing its last result while the new one loads
+                        current_ear, score, status_label = 0.0, 0.0, "DETECTOR RESTART"
+                    if result is not None:
+                        processed, ear, mar, drowsy, yawn, face, score = result
+                        current_ear = ear
+                        if not face: status_label = "!!! NO FACE !!!"
+                        elif drowsy: status_label = "DRWS!"
+                        elif yawn: status_label = "YAWN"
+                        else: status_label = "OK"
+
+                        if display: #? in standalone perchè display abilitato?
+                            imshow("Raspberry Standalone", processed)
+                            if wait_key(1) & 0xFF == ord('q'): break
 
-                    if config.DISPLAY_ENABLED: #? in standalone perchè display abilitato?
-                        cv2.imshow("Raspberry Standalone", processed)
-                        if cv2.waitKey(1) & 0xFF == ord('q'): break
+                # Sent or copied to the detector: the ring slot can be reused
+                release_frame(frame)
 
                 # 3. STATUS PRINT
-                if self.frame_count % config.CAMERA_FPS == 0:
-                    elapsed = time.time() - self.start_time
+                if self.frame_count % stats_every == 0:
+                    now = time.time()
+                    elapsed = now - self.start_time
                     fps = self.frame_count / elapsed if elapsed > 0 else 0
                     cpu_temp, cpu_usage, ram = self.get_system_stats()
 
-                    def to_comma_str(val):
-                        return str(val).replace('.', ',')
+                    sec = int(now)
+                    if sec != last_sec:
+                        last_sec = sec
+                        csv_ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+                        clock_ts = csv_ts[11:]
                     # Registra i dati per il CSV
                     self.log_history.append({
-                        "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        "timestamp": csv_ts,
                         "mode": mode_label,
                         "fps": to_comma_str(round(fps, 1)),
                         "ear": to_comma_str(round(current_ear, 3)) if not self.connected else "N/A",
@@ -313,19 +491,40 @@ class SmartRaspberryClient:
                     ear_str = f"EAR: {current_ear:.2f}" if not self.connected else "EAR: PC-Side"
                     score_str = f"SCORE: {score:.1f}" if not self.connected else "SCORE: PC-Side"
                     
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] "
-                          f"MODE: {mode_label} | {score_str} | FPS: {fps:.1f} | {ear_str} | {status_label} || {sys_stats}")
+                    log.info(f"[{clock_ts}] "
+                             f"MODE: {mode_label} | {score_str} | FPS: {fps:.1f} | {ear_str} | {status_label} || {sys_stats}")
 
         except KeyboardInterrupt:
             self.save_logs_on_exit()
-            print("\n[STOP] User interrupted")
+            log.info("\n[STOP] User interrupted")
         finally:
+            log_listener.stop()  # Flushes the queued messages
+            pipeline.stop()
+            detector.close()
             self.save_logs_on_exit()
+            if self._pending_socket: self._pending_socket.close()
             if self.socket: self.socket.close()
+            if self.hw_stream: self.camera.stop_encoder()
             if self.use_picamera2: self.camera.stop()
             else: self.camera.release()
             cv2.destroyAllWindows()
 
+def parse_size(value):
+    """argparse type for 'WxH' sizes"""
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}', expected WxH (e.g. 256x192)")
+    return width, height
+
 if __name__ == "__main__":
-    client = SmartRaspberryClient(config.PC_SERVER_IP, config.PC_SERVER_PORT)
+    parser = argparse.ArgumentParser(description="Raspberry Pi drowsiness detection client (hybrid)")
+    parser.add_argument("--codec", choices=["jpeg", "mjpeg", "h264"], default=config.STREAM_CODEC,
+                        help="stream codec sent to the PC server (mjpeg/h264 = Pi hardware encoders)")
+    parser.add_argument("--detect-size", type=parse_size, default=None, metavar="WxH",
+                        help="frame size captured (scaled by the Pi ISP), detected on and streamed as is "
+                             "(default: camera size, JPEG stream downscaled to SEND_WIDTHxSEND_HEIGHT)")
+    args = parser.parse_args()
+    client = SmartRaspberryClient(config.PC_SERVER_IP, config.PC_SERVER_PORT,
+                                  codec=args.codec, frame_size=args.detect_size)
     client.run()
\ No newline at end of file
@@ -6,6 +6,14 @@ PC_SERVER_IP = "192.168.1.219"  # PC'S IP
 PC_SERVER_PORT = 5555
 CONNECTION_TIMEOUT = 10
 RECONNECT_DELAY = 5
+SEND_BUFFER_SIZE = 256 * 1024  # Socket send buffer: room for a few JPEG frames, not seconds of video
+ZEROCOPY_SEND = False          # Linux MSG_ZEROCOPY for large frames (kernel >= 4.14), saves the kernel-side copy
+# Dead-server detection without app-level pings: keepalive probes while idle,
+# TCP_USER_TIMEOUT while frames are waiting for an ACK (a send then fails instead of hanging)
+KEEPALIVE_IDLE = 3             # Seconds of silence before the first probe
+KEEPALIVE_INTERVAL = 1         # Seconds between probes
+KEEPALIVE_COUNT = 2            # Unanswered probes before the connection is dropped
+TCP_USER_TIMEOUT_MS = 3000     # Max time sent data may stay unacknowledged (Linux)
 
 # ===================== DETECTION THRESHOLDS (Standalone-only) =====================
 # MediaPipe is very accurate, standard thresholds work well
@@ -13,14 +21,49 @@ EAR_THRESHOLD = 0.25       # Default Eye Aspect Ratio threshold (eyes closed if
 EAR_CONSEC_FRAMES = 10     # Consecutive frames for alert
 MAR_THRESHOLD = 0.6        # Default Mouth Aspect Ratio threshold for yawning
 YAWN_CONSEC_FRAMES = 8     # Consecutive frames for yawn detection
+# Reuse the last landmarks for one frame when EAR and MAR moved less than this (0 = off).
+# Halves MediaPipe calls on a still face, but a blink starting on a skipped frame is seen one frame late
+LANDMARK_REUSE_DELTA = 0.0
+# MediaPipe Tasks API only. LIVE_STREAM runs FaceLandmarker asynchronously: detect() gets the
+# landmarks of the previous frame while the current one is processed (one frame late, never blocks)
+MEDIAPIPE_LIVE_STREAM = False
+MEDIAPIPE_GPU = False      # GPU delegate, falls back to CPU where it is not available (e.g. Pi)
+# Legacy Solutions API only: iris/lip refinement model. The 16 EAR/MAR landmarks are all in the
+# base 468-point mesh, so it only adds inference time (True = slightly steadier eye/mouth points)
+REFINE_LANDMARKS = False
 # ===================== CAMERA (Both standalone and server)===================================
 # With MediaPipe we can dare a slightly higher resolution if we want,
 # but 320x240 is the ideal resolution for maximizing FPS on Pi 3B+
 CAMERA_WIDTH = 320
 CAMERA_HEIGHT = 240
 CAMERA_FPS = 20  # Slightly increased (it was 15) because MediaPipe is faster
-# JPEG Compression (70 = good quality/bandwidth compromise)
-JPEG_QUALITY = 70
+# JPEG Compression (60 = good quality/bandwidth compromise at the send size)
+JPEG_QUALITY = 60
+# Size of the JPEG frames streamed to the PC (software "jpeg" codec): the eye region still has
+# enough pixels for the landmarks, and each JPEG is about half the 320x240 one.
+# Costs a CPU resize per frame; raspberry_client_hybrid.py --detect-size WxH captures at WxH
+# in the ISP and streams that size instead, without resizing
+SEND_WIDTH = 192
+SEND_HEIGHT = 144
+# Stream codec: "jpeg" (software, per frame), "mjpeg" (Pi hardware JPEG encoder)
+# or "h264" (Pi hardware encoder, needs PyAV on the PC)
+STREAM_CODEC = "jpeg"
+H264_BITRATE = 2000000
+MJPEG_BITRATE = 4000000       # Hardware MJPEG: the encoder picks the JPEG quality from the bitrate
+# Skip encode+send of near-duplicate frames (8x8 aHash), the server re-analyzes the previous one.
+# Off by default: a slow eye closure barely changes the hash and would be seen up to FORCE_SEND_EVERY frames late
+SKIP_DUPLICATE_FRAMES = False
+DUPLICATE_HASH_DISTANCE = 3   # Hash bits that must change for a frame to count as new
+FORCE_SEND_EVERY = 15         # Always send at least one frame every N
+
+# ===================== CPU AFFINITY (Raspberry Pi) =====================
+# Core of each pipeline stage (None = let the scheduler decide). On a 4-core Pi every stage
+# keeps its own caches warm; cores that don't exist on the machine are ignored.
+CAPTURE_CPU = 0
+ENCODE_CPU = 1
+SEND_CPU = 2               # Main loop: sends frames in CLIENT mode
+DETECT_CPU = 3             # Standalone MediaPipe worker process
+SENDER_RT_PRIORITY = 0     # SCHED_FIFO priority of the main loop (1-99, needs root/CAP_SYS_NICE), 0 = off
 
 # ===================== VIEW (Standalone-only) ====================================
 SHOW_LANDMARKS = True      # Show eye/mouth landmarks
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+detector_process.py - DrowsinessAnalyzer running in a worker process
+Used by the Raspberry Pi client in standalone mode: MediaPipe inference runs on
+its own core while capture and streaming keep going on the main process.
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+# Import config from the same 'shared' folder
+try:
+    from . import config  # When imported as a package
+    from .streaming import pin_thread
+except ImportError:
+    import config  # When executed directly
+    from streaming import pin_thread
+
+# Worker result: ear, mar, is_drowsy, is_yawning, face_detected, score
+RESULT_SIZE = 6
+# Worker crashes tolerated before poll() gives up and raises
+MAX_RESTARTS = 3
+
+
+def _worker_main(shm_name, shape, slot, frame_ready, result_ready, result, threshold, stop, cpu, draw):
+    """Worker process: waits for a frame in shared memory, runs detect, publishes the result"""
+    pin_thread(cpu)  # Main thread of the worker: the whole process starts on its core
+    cv2.setNumThreads(1)  # Spawned process: OpenCV settings are per process
+
+    try:
+        from .drowsiness_analyzer import DrowsinessAnalyzer
+    except ImportError:
+        from drowsiness_analyzer import DrowsinessAnalyzer
+    analyzer = DrowsinessAnalyzer(draw=draw)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        while not stop.is_set():
+            if not frame_ready.wait(timeout=0.5):
+                continue
+            frame_ready.clear()
+            if threshold.value > 0:
+                analyzer.ear_threshold = threshold.value
+            # detect() draws on the frame in place (if draw): the annotated frame stays in its slot
+            _, ear, mar, drowsy, yawn, face, score = analyzer.detect(frames[slot.value])
+            result[:] = (ear, mar, drowsy, yawn, face, score)
+            result_ready.set()
+    finally:
+        del frames
+        shm.close()
+
+
+class DetectorProcess:
+    """
+    DrowsinessAnalyzer.detect running in a separate process.
+    Frames travel through a SharedMemory ring of 2 slots (ping-pong): the worker analyzes
+    one slot while the next frame goes into the other, so the annotated frame of the last
+    result stays valid. submit() and poll() never block: capture never waits for MediaPipe.
+    A worker that dies is detected by poll(), reported and restarted (RuntimeError after
+    MAX_RESTARTS crashes), so standalone detection never stalls silently.
+    """
+
+    def __init__(self, width=config.CAMERA_WIDTH, height=config.CAMERA_HEIGHT, cpu=config.DETECT_CPU,
+                 draw=config.DISPLAY_ENABLED):
+        # 'spawn': don't fork a process that already runs MediaPipe and capture threads
+        ctx = mp.get_context('spawn')
+        self.shape = (2, height, width, 3)
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self._frames = np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self._slot = ctx.Value('i', 0, lock=False)
+        self._result = ctx.Array('d', RESULT_SIZE, lock=False)
+        self._threshold = ctx.Value('d', 0.0, lock=False)  # EAR threshold override (0 = analyzer's own)
+        self._frame_ready = ctx.Event()
+        self._result_ready = ctx.Event()
+        self._stop = ctx.Event()
+        self._next = 0       # Slot of the frame being (or to be) analyzed
+        self._busy = False   # A frame was submitted and its result not collected yet
+        self._ctx = ctx
+        self._args = (self._shm.name, self.shape, self._slot, self._frame_ready,
+                      self._result_ready, self._result, self._threshold, self._stop, cpu, draw)
+        self._restarts = 0
+        self.restarting = False  # True from a worker crash until the new worker's first result
+        self._proc = ctx.Process(target=_worker_main, args=self._args, daemon=True)
+
+    def start(self):
+        self._proc.start()
+
+    def _restart(self):
+        """The worker died (e.g. a MediaPipe crash): report it and start a new one"""
+        self._restarts += 1
+        print(f"[ERROR] Detector process died (exit code {self._proc.exitcode})")
+        if self._restarts > MAX_RESTARTS:
+            raise RuntimeError(f"Detector process crashed {self._restarts} times, standalone detection stopped")
+        print(f"[WARN] Restarting detector process ({self._restarts}/{MAX_RESTARTS})...")
+        self._frame_ready.clear()
+        self._result_ready.clear()
+        self._busy = False  # The frame it was analyzing is lost
+        self.restarting = True
+        self._proc = self._ctx.Process(target=_worker_main, args=self._args, daemon=True)
+        self._proc.start()
+
+    def set_ear_threshold(self, value):
+        """EAR threshold used from the next frame on (e.g. after a calibration done meanwhile)"""
+        self._threshold.value = value
+
+    def submit(self, frame):
+        """Hands a BGR frame to the worker. Returns False (frame skipped) if it is still busy"""
+        if self._busy:
+            return False
+        h, w = self.shape[1:3]
+        if frame.shape[:2] != (h, w):
+            frame = cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)
+        np.copyto(self._frames[self._next], frame)
+        self._slot.value = self._next
+        self._busy = True
+        self._frame_ready.set()
+        return True
+
+    def poll(self):
+        """
+        Returns (processed_frame, ear, mar, is_drowsy, is_yawning, face_detected, score)
+        when a new result is ready, None otherwise.
+        processed_frame is valid until the next-but-one submit().
+        """
+        if not self._result_ready.is_set():
+            if self._busy and not self._proc.is_alive():
+                self._restart()
+            return None
+        self._result_ready.clear()
+        self.restarting = False
+        slot = self._next
+        self._next ^= 1
+        self._busy = False
+        ear, mar, drowsy, yawn, face, score = self._result[:]
+        return self._frames[slot], ear, mar, bool(drowsy), bool(yawn), bool(face), score
+
+    def close(self):
+        self._stop.set()
+        self._proc.join(timeout=2.0)
+        if self._proc.is_alive():
+            self._proc.terminate()
+        del self._frames
+        self._shm.close()
+        self._shm.unlink()
@@ -7,9 +7,12 @@ Compatible with MediaPipe >= 0.10.0 (new tasks API).
 
 import os
 import json
+import time
+import queue
+import threading
+from collections import OrderedDict
 import cv2
 import numpy as np
-from scipy.spatial import distance
 from datetime import datetime
 
 # SILENCE MEDIAPIPE LOGS
@@ -31,12 +34,90 @@ import mediapipe as mp
 # Check which API is available
 USE_NEW_API = not hasattr(mp, 'solutions')
 
+# Numba (optional): compiles the per-frame EAR/MAR and score kernels, plain Python otherwise.
+# The kernels only use constructs supported in nopython mode
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda fn: fn
+
+# Rendered text labels kept by DrowsinessAnalyzer._blit_label (LRU)
+TEXT_CACHE_SIZE = 512
+FACE_LOST_TEXT = "!!! FACE LOST !!!"
+# Returned by _process_frame_new_api in LIVE_STREAM mode when no new result arrived
+NO_NEW_RESULT = object()
+
+
+@njit(cache=True, fastmath=True)
+def _ear_mar_decide(landmarks, pairs_a, pairs_b, ear_thr, mar_thr,
+                    ear_cnt, yawn_cnt, ear_frames, yawn_frames):
+    """
+    Numeric tail of detect(): EAR, MAR and consecutive-frame counters.
+    All 8 distances come from one batched gather (pairs_a[i] - pairs_b[i]), in the order
+    left eye (v1, v2, h), right eye (v1, v2, h), mouth (v, h).
+    Returns (ear, mar, is_drowsy, is_yawning, ear_cnt, yawn_cnt, drowsy_edge, yawn_edge);
+    the *_edge flags are True only on the frame that starts a new event.
+    """
+    d = landmarks[pairs_a] - landmarks[pairs_b]  # float32 pixel coordinates, no cast
+    dx = d[:, 0]
+    dy = d[:, 1]
+    dist = np.sqrt(dx * dx + dy * dy)
+    left = (dist[0] + dist[1]) / (2.0 * dist[2]) if dist[2] != 0 else 0.0
+    right = (dist[3] + dist[4]) / (2.0 * dist[5]) if dist[5] != 0 else 0.0
+    ear = float((left + right) / 2.0)
+    mar = float(dist[6] / dist[7]) if dist[7] != 0 else 0.0
+
+    # Compiled, these compare-and-select branches become conditional moves
+    ear_cnt = ear_cnt + 1 if ear < ear_thr else 0
+    yawn_cnt = yawn_cnt + 1 if mar > mar_thr else 0
+    return (ear, mar, ear_cnt >= ear_frames, yawn_cnt >= yawn_frames,
+            ear_cnt, yawn_cnt, ear_cnt == ear_frames, yawn_cnt == yawn_frames)
+
+
+@njit(cache=True)
+def _score_kernel(ear, mar, ear_thr, inv_ear_thr, mar_thr, inv_mar_range,
+                  n_drowsy, inv_ear_consec, n_yawn, inv_yawn_consec):
+    """
+    Scalar body of DrowsinessAnalyzer.calculate_drowsiness_score (native floats under Numba).
+    Divisors arrive as precomputed reciprocals; each clamp is a min/max pair, which
+    compiles to branchless minsd/maxsd.
+    """
+    # 1. Score EAR (occhi chiusi), normalizzato rispetto alla soglia
+    ear_value_score = min(max((ear_thr - ear) * inv_ear_thr * 100.0, 0.0), 100.0)
+    # 2. Score durata occhi chiusi: massimo quando raggiunge EAR_CONSEC_FRAMES
+    ear_duration_score = min(n_drowsy * inv_ear_consec * 100.0, 100.0)
+    # 3. Score MAR (sbadigli)
+    mar_value_score = min(max((mar - mar_thr) * inv_mar_range * 100.0, 0.0), 100.0)
+    # 4. Score durata sbadigli
+    yawn_duration_score = min(n_yawn * inv_yawn_consec * 100.0, 100.0)
+
+    # 5. Punteggio finale: value + duration al 50%, poi 80% occhi chiusi, 20% sbadigli
+    return (0.4 * (ear_value_score + ear_duration_score)
+            + 0.1 * (mar_value_score + yawn_duration_score))
+
 
 class DrowsinessAnalyzer:
     """Drowsiness analyzer based on MediaPipe Face Mesh"""
     
-    def __init__(self):
+    def __init__(self, draw=True, input_is_rgb=False):
+        """
+        draw=False: no landmarks/text on the frame (headless clients, nobody sees it)
+        input_is_rgb=True: detect() receives RGB frames (e.g. decoded straight to RGB) and
+        skips the BGR->RGB conversion; overlays are drawn in RGB order to match
+        """
         print("[INFO] Loading MediaPipe Face Mesh...")
+        print(f"[INFO] EAR/MAR kernels: {'Numba (compiled)' if HAS_NUMBA else 'NumPy (numba not installed)'}")
+        self.draw = draw
+        self.input_is_rgb = input_is_rgb
+        # Overlay colors in the channel order of the frames detect() draws on
+        order = (lambda c: c[::-1]) if input_is_rgb else (lambda c: c)
+        self._RED, self._GREEN, self._YELLOW = order((0, 0, 255)), (0, 255, 0), order((0, 255, 255))
         
         if USE_NEW_API:
             self._init_new_api()
@@ -46,13 +127,33 @@ class DrowsinessAnalyzer:
         self.config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ear_config.json")
         self.ear_threshold = self.load_threshold()
 
-        # MEDIAPIPE INDICES (different from dlib)
+        # MEDIAPIPE INDICES (different from dlib), np.intp: native index type for fancy indexing
         # Left Eye (key points for EAR)
-        self.LEFT_EYE = [33, 160, 158, 133, 153, 144]
+        self.LEFT_EYE = np.array([33, 160, 158, 133, 153, 144], dtype=np.intp)
         # Right Eye
-        self.RIGHT_EYE = [362, 385, 387, 263, 373, 380]
+        self.RIGHT_EYE = np.array([362, 385, 387, 263, 373, 380], dtype=np.intp)
         # Mouth (key points for MAR: top, bottom, left, right)
-        self.MOUTH = [13, 14, 61, 291] 
+        self.MOUTH = np.array([13, 14, 61, 291], dtype=np.intp)
+        # Only these 16 landmarks are read back from MediaPipe (out of 468/478), in this order;
+        # the *_PTS indices address that compact array
+        self._landmark_ids = tuple(int(i) for i in np.concatenate([self.LEFT_EYE, self.RIGHT_EYE, self.MOUTH]))
+        self.LEFT_EYE_PTS = np.arange(0, 6, dtype=np.intp)
+        self.RIGHT_EYE_PTS = np.arange(6, 12, dtype=np.intp)
+        self.MOUTH_PTS = np.arange(12, 16, dtype=np.intp)
+        # Point pairs of all EAR/MAR distances (compact indices), see _ear_mar_decide
+        self._PAIRS_A = np.concatenate([self.LEFT_EYE_PTS[[1, 2, 0]], self.RIGHT_EYE_PTS[[1, 2, 0]],
+                                        self.MOUTH_PTS[[0, 2]]])
+        self._PAIRS_B = np.concatenate([self.LEFT_EYE_PTS[[5, 4, 3]], self.RIGHT_EYE_PTS[[5, 4, 3]],
+                                        self.MOUTH_PTS[[1, 3]]])
+        # Preallocated landmark buffers: float32 pixel coordinates for the EAR/MAR math,
+        # int32 copy filled only when drawing
+        n_pts = len(self._landmark_ids)
+        self._pts = np.empty((n_pts, 2), dtype=np.float32)
+        self._pts_px = np.empty((n_pts, 2), dtype=np.int32)
+        self._scale = np.ones(2, dtype=np.float32)  # (w, h) of the last frame
+        self._shape_cache = (0, 0)  # (h, w) _scale was set for: fixed-resolution capture sets it once
+        # Mouth points in contour order for drawing: top, left, bottom, right
+        self._MOUTH_CONTOUR = np.array([12, 14, 13, 15], dtype=np.intp)
         
         # Counters
         self.ear_counter = 0
@@ -60,9 +161,37 @@ class DrowsinessAnalyzer:
         self.total_drowsy_events = 0
         self.total_yawn_events = 0
         self.face_lost_counter = 0
+        self._last_outcome = (0.0, 0.0, False, False, False)  # ear, mar, drowsy, yawning, face
         self.face_lost_threshold = config.CAMERA_FPS # 1 second of lost face
         self.drowsiness_score = 0.0
 
+        # RGB input buffer reused across frames (reallocated only if the frame size changes)
+        self._rgb = None
+        # Config values read every frame by detect(), bound once
+        self._mar_threshold = config.MAR_THRESHOLD
+        self._ear_frames = config.EAR_CONSEC_FRAMES
+        self._yawn_frames = config.YAWN_CONSEC_FRAMES
+        # Reciprocals for calculate_drowsiness_score (no divisions per frame)
+        self._inv_mar_range = 1.0 / (1.0 - config.MAR_THRESHOLD)
+        self._inv_ear_frames = 1.0 / config.EAR_CONSEC_FRAMES
+        self._inv_yawn_frames = 1.0 / config.YAWN_CONSEC_FRAMES
+        self._reuse_delta = config.LANDMARK_REUSE_DELTA
+        self._show_landmarks = config.SHOW_LANDMARKS
+        self._show_ear_mar = config.SHOW_EAR_MAR
+        # Landmark reuse on stable frames (config.LANDMARK_REUSE_DELTA)
+        self._last_pts = None
+        self._last_ear_mar = (0.0, 0.0)
+        self._reuse_next = False
+        # Label masks by (text, scale, thickness): EAR/MAR/Score strings repeat a lot
+        self._text_cache = OrderedDict()
+        self._face_lost_size = None  # (w, h) the FACE LOST position was computed for
+        self._face_lost_org = (0, 0)
+        # Event log written by a background thread: detect() never waits for the SD card
+        self._log_q = None
+        if config.LOG_EVENTS:
+            self._log_q = queue.Queue(maxsize=256)
+            threading.Thread(target=self._log_worker, name="event-log", daemon=True).start()
+
         print("[INFO] MediaPipe Analyzer ready!")
     
     def calculate_drowsiness_score(self, ear, mar):
@@ -79,33 +208,20 @@ class DrowsinessAnalyzer:
         Returns:
             score: 0-100 (100 = massima sonnolenza)
         """
-        # 1. Score EAR (occhi chiusi)
-        # Normalizza EAR rispetto alla soglia
-        ear_value_score = max(0, (self.ear_threshold - ear) / self.ear_threshold) * 100
-        ear_value_score = min(ear_value_score, 100)
-        
-        # 2. Score durata occhi chiusi
-        # Massimizza quando raggiunge EAR_CONSEC_FRAMES
-        ear_duration_score = min(100, (self.total_drowsy_events / config.EAR_CONSEC_FRAMES) * 100)
-        
-        # Combina EAR value + duration (50% + 50%)
-        ear_total_score = (ear_value_score * 0.5) + (ear_duration_score * 0.5)
-        
-        # 3. Score MAR (sbadigli)
-        mar_value_score = max(0, (mar - config.MAR_THRESHOLD) / (1.0 - config.MAR_THRESHOLD)) * 100
-        mar_value_score = min(mar_value_score, 100)
-        
-        # 4. Score durata sbadagli
-        yawn_duration_score = min(100, (self.total_yawn_events / config.YAWN_CONSEC_FRAMES) * 100)
-        
-        # Combina MAR value + duration (50% + 50%)
-        mar_total_score = (mar_value_score * 0.5) + (yawn_duration_score * 0.5)
-        
-        # 5. Punteggio finale
-        # 80% occhi chiusi, 20% sbadigli
-        drowsiness_score = (ear_total_score * 0.8) + (mar_total_score * 0.2)
-        
-        return drowsiness_score
+        return _score_kernel(ear, mar, self._ear_threshold, self._inv_ear_threshold,
+                             self._mar_threshold, self._inv_mar_range,
+                             self.total_drowsy_events, self._inv_ear_frames,
+                             self.total_yawn_events, self._inv_yawn_frames)
+
+    @property
+    def ear_threshold(self):
+        return self._ear_threshold
+
+    @ear_threshold.setter
+    def ear_threshold(self, value):
+        # Calibration and the PC server assign it directly: keep the reciprocal in sync
+        self._ear_threshold = value
+        self._inv_ear_threshold = 1.0 / value if value else 0.0
 
     #?Non bastano solo nuove?
     def _init_new_api(self):
@@ -116,19 +232,50 @@ class DrowsinessAnalyzer:
         print("[INFO] Using MediaPipe Tasks API (New)")
         
         # Use FaceLandmarker from the new API
-        base_options = mp_python.BaseOptions(
-            model_asset_path=self._get_model_path()
-        )
-        options = vision.FaceLandmarkerOptions(
-            base_options=base_options,
-            running_mode=vision.RunningMode.IMAGE,
-            num_faces=1,
-            min_face_detection_confidence=0.5,
-            min_tracking_confidence=0.5
-        )
-        self.face_landmarker = vision.FaceLandmarker.create_from_options(options)
+        live = config.MEDIAPIPE_LIVE_STREAM
+        if live:
+            mode_options = dict(running_mode=vision.RunningMode.LIVE_STREAM, result_callback=self._on_result)
+        else:
+            # VIDEO: the face detector only runs when landmark tracking is lost
+            mode_options = dict(running_mode=vision.RunningMode.VIDEO)
+
+        delegates = [mp_python.BaseOptions.Delegate.GPU] if config.MEDIAPIPE_GPU else []
+        for delegate in delegates + [None]:
+            base_options = mp_python.BaseOptions(
+                model_asset_path=self._get_model_path(),
+                delegate=delegate  # None = MediaPipe default (CPU)
+            )
+            options = vision.FaceLandmarkerOptions(
+                base_options=base_options,
+                num_faces=1,
+                min_face_detection_confidence=0.5,
+                min_tracking_confidence=0.5,
+                **mode_options
+            )
+            try:
+                self.face_landmarker = vision.FaceLandmarker.create_from_options(options)
+                break
+            except (RuntimeError, ValueError) as e:
+                if delegate is None:
+                    raise
+                print(f"[WARN] GPU delegate not available ({e}), using CPU")
+
+        # Bound once, called every frame
+        self._landmark_fn = self.face_landmarker.detect_async if live else self.face_landmarker.detect_for_video
+        self._live_stream = live
+        self._latest_result = None  # LIVE_STREAM: (timestamp_ms, result) published by the callback thread
+        self._last_result_ts = -1   # Timestamp of the LIVE_STREAM result detect() consumed last
+        self._last_ts_ms = -1  # VIDEO/LIVE_STREAM need strictly increasing timestamps
+        # mp.Image copies the pixels when it is built, so it cannot wrap a reused buffer:
+        # only the class and format lookups are hoisted out of the frame loop
+        self._mp_image = mp.Image
+        self._srgb = mp.ImageFormat.SRGB
         self.use_new_api = True
     
+    def _on_result(self, result, output_image, timestamp_ms):
+        """LIVE_STREAM callback (MediaPipe thread): a single reference store, atomic for readers"""
+        self._latest_result = (timestamp_ms, result)
+
     def _init_legacy_api(self):
         """Initializes with the old MediaPipe Solutions API (< 0.10.0)"""
         print("[INFO] Using MediaPipe Solutions API (Legacy)")
@@ -136,10 +283,11 @@ class DrowsinessAnalyzer:
         self.mp_face_mesh = mp.solutions.face_mesh
         self.face_mesh = self.mp_face_mesh.FaceMesh(
             max_num_faces=1,
-            refine_landmarks=True, # To improve mouth and eye landmarks on standalone version
+            refine_landmarks=config.REFINE_LANDMARKS,  # EAR/MAR indices are all < 468: no iris model needed
             min_detection_confidence=0.5,
             min_tracking_confidence=0.5,
         )
+        self._landmark_fn = self.face_mesh.process  # Bound once, called every frame
         self.use_new_api = False
     
     def _get_model_path(self):
@@ -184,65 +332,83 @@ class DrowsinessAnalyzer:
         except Exception as e:
             print(f"[ERROR] Could not save threshold: {e}")
 
-    def eye_aspect_ratio(self, landmarks, indices):
-        """Calculates EAR given specific landmarks """
-        pts = [landmarks[i] for i in indices]
-        
-        # Calculate vertical distances
-        A = distance.euclidean(pts[1], pts[5])
-        B = distance.euclidean(pts[2], pts[4])
-        # Calculate horizontal distance
-        C = distance.euclidean(pts[0], pts[3])
-        
-        if C == 0: return 0.0
-        return (A + B) / (2.0 * C)
-    
-    def mouth_aspect_ratio(self, landmarks, indices):
-        """Calculates MAR (vertical distance / horizontal distance)"""
-        pts = [landmarks[i] for i in indices]
-        
-        # pts[0]=Top(13), pts[1]=Bottom(14), pts[2]=Left(61), pts[3]=Right(291)
-        A = distance.euclidean(pts[0], pts[1])  # Vertical
-        C = distance.euclidean(pts[2], pts[3])  # Horizontal
-        
-        if C == 0: return 0.0
-        return A / C
-    
+    def _to_rgb(self, frame):
+        """BGR -> RGB into the preallocated buffer (no new array per frame)"""
+        if self.input_is_rgb:
+            return frame
+        if self._rgb is None or self._rgb.shape != frame.shape:
+            self._rgb = np.empty_like(frame)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb)
+
     def _process_frame_new_api(self, frame):
         """Processes frame with the new API"""
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_frame)
-        result = self.face_landmarker.detect(mp_image)
+        rgb_frame = self._to_rgb(frame)
+        mp_image = self._mp_image(image_format=self._srgb, data=rgb_frame)
+        ts_ms = max(int(time.monotonic() * 1000), self._last_ts_ms + 1)
+        self._last_ts_ms = ts_ms
+        if self._live_stream:
+            # Queue this frame, use what an earlier one produced if it was not consumed yet
+            self._landmark_fn(mp_image, ts_ms)
+            latest = self._latest_result
+            if latest is None or latest[0] == self._last_result_ts:
+                return NO_NEW_RESULT
+            self._last_result_ts, result = latest
+        else:
+            result = self._landmark_fn(mp_image, ts_ms)
         
         if result.face_landmarks:
-            h, w = frame.shape[:2]
-            landmarks = result.face_landmarks[0]
-            landmarks_np = np.array([(int(lm.x * w), int(lm.y * h)) for lm in landmarks])
-            return landmarks_np
+            return self._extract_points(result.face_landmarks[0])
         return None
     
     def _process_frame_legacy_api(self, frame):
         """Processes frame with the legacy API"""
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        results = self.face_mesh.process(rgb_frame)
+        rgb_frame = self._to_rgb(frame)
+        # Read-only input: the Solutions API passes it by reference instead of copying it.
+        # With input_is_rgb this is the caller's array: its original flag is restored as it was
+        writeable = rgb_frame.flags.writeable
+        rgb_frame.flags.writeable = False
+        try:
+            results = self._landmark_fn(rgb_frame)
+        finally:
+            if writeable:
+                rgb_frame.flags.writeable = True
         
         if results.multi_face_landmarks:
-            h, w = frame.shape[:2]
-            face_landmarks = results.multi_face_landmarks[0]
-            landmarks_np = np.array([(int(lm.x * w), int(lm.y * h)) for lm in face_landmarks.landmark])
-            return landmarks_np
+            return self._extract_points(results.multi_face_landmarks[0].landmark)
         return None
+
+    def _extract_points(self, landmarks):
+        """Pixel coordinates (float32) of the EAR/MAR landmarks only (compact array, see *_PTS)"""
+        pts = self._pts
+        pts[:] = [(landmarks[i].x, landmarks[i].y) for i in self._landmark_ids]
+        np.multiply(pts, self._scale, out=pts)  # _scale kept in sync with the frame by detect()
+        return pts
     
     def detect(self, frame):
         """
         Detects drowsiness in the frame using MediaPipe.
         Returns: (processed_frame, ear, mar, is_drowsy, is_yawning)
         """
-        h, w = frame.shape[:2]
+        shape = frame.shape[:2]
+        if shape != self._shape_cache:
+            self._shape_cache = shape
+            self._scale[0], self._scale[1] = shape[1], shape[0]
+        h, w = shape
         
-        # Process with the appropriate API
-        if self.use_new_api:
+        # Process with the appropriate API (or reuse the last landmarks on a stable face)
+        reused = self._reuse_next
+        if reused:
+            landmarks_np = self._last_pts
+            self._reuse_next = False
+        elif self.use_new_api:
             landmarks_np = self._process_frame_new_api(frame)
+            if landmarks_np is NO_NEW_RESULT:
+                # LIVE_STREAM, nothing new since the last call: repeat the last outcome without
+                # counting it again (counters and events advance once per MediaPipe result)
+                ear, mar, is_drowsy, is_yawning, face_detected = self._last_outcome
+                if face_detected and self.draw:
+                    self._draw_overlay(frame, self._last_pts, ear, mar, is_drowsy, is_yawning)
+                return frame, ear, mar, is_drowsy, is_yawning, face_detected, self.drowsiness_score
         else:
             landmarks_np = self._process_frame_legacy_api(frame)
         
@@ -254,11 +420,19 @@ class DrowsinessAnalyzer:
         
         if landmarks_np is not None:
             self.face_lost_counter = 0
-            # Calculate EAR
-            left_ear = self.eye_aspect_ratio(landmarks_np, self.LEFT_EYE)
-            right_ear = self.eye_aspect_ratio(landmarks_np, self.RIGHT_EYE)
-            ear = (left_ear + right_ear) / 2.0
-            mar = self.mouth_aspect_ratio(landmarks_np, self.MOUTH)
+            # EAR, MAR and counters in one compiled call
+            (ear, mar, is_drowsy, is_yawning, self.ear_counter, self.yawn_counter,
+             drowsy_edge, yawn_edge) = _ear_mar_decide(
+                landmarks_np, self._PAIRS_A, self._PAIRS_B, self._ear_threshold, self._mar_threshold,
+                self.ear_counter, self.yawn_counter, self._ear_frames, self._yawn_frames)
+            
+            # Stable face (EAR/MAR barely moved): skip MediaPipe on the next frame
+            reuse_delta = self._reuse_delta
+            if reuse_delta > 0 and not reused:
+                last_ear, last_mar = self._last_ear_mar
+                self._reuse_next = abs(ear - last_ear) < reuse_delta and abs(mar - last_mar) < reuse_delta
+            self._last_pts = landmarks_np
+            self._last_ear_mar = (ear, mar)
             
             # --- DETECTION LOGIC ---
             
@@ -266,54 +440,22 @@ class DrowsinessAnalyzer:
             new_drowsiness_score = self.calculate_drowsiness_score(ear, mar)
 
             # Drowsiness
-            if ear < self.ear_threshold:
-                self.ear_counter += 1
-                if self.ear_counter >= config.EAR_CONSEC_FRAMES:
-                    is_drowsy = True
-                    if self.ear_counter == config.EAR_CONSEC_FRAMES:
-                        self.total_drowsy_events += 1
-                        self.drowsiness_score = new_drowsiness_score
-                        self._log_event("DROWSINESS_DETECTED")
-                        print(f"[⚠️ ALERT] DROWSINESS! Event #{self.total_drowsy_events} (Score: {self.drowsiness_score:.1f})")
-            else:
-                self.ear_counter = 0
+            if drowsy_edge:
+                self.total_drowsy_events += 1
+                self.drowsiness_score = new_drowsiness_score
+                self._log_event("DROWSINESS_DETECTED")
+                print(f"[⚠️ ALERT] DROWSINESS! Event #{self.total_drowsy_events} (Score: {self.drowsiness_score:.1f})")
             
             # Yawning
-            if mar > config.MAR_THRESHOLD:
-                self.yawn_counter += 1
-                if self.yawn_counter >= config.YAWN_CONSEC_FRAMES:
-                    is_yawning = True
-                    if self.yawn_counter == config.YAWN_CONSEC_FRAMES:
-                        self.total_yawn_events += 1
-                        self.drowsiness_score = new_drowsiness_score
-                        self._log_event("YAWN_DETECTED")
-                        print(f"[🥱 INFO] YAWN! Event #{self.total_yawn_events} (Score: {self.drowsiness_score:.1f})")
-            else:
-                self.yawn_counter = 0
+            if yawn_edge:
+                self.total_yawn_events += 1
+                self.drowsiness_score = new_drowsiness_score
+                self._log_event("YAWN_DETECTED")
+                print(f"[🥱 INFO] YAWN! Event #{self.total_yawn_events} (Score: {self.drowsiness_score:.1f})")
             
-            # --- DRAWING ---
-            if config.SHOW_LANDMARKS:
-                color_drowsy = (0, 0, 255) if is_drowsy else (0, 255, 0)
-                color_yawn = (0, 0, 255) if is_yawning else (0, 255, 255)
-                
-                # Draw Eyes 
-                for idx in self.LEFT_EYE:
-                    cv2.circle(frame, tuple(landmarks_np[idx]), 1, color_drowsy, -1)
-                for idx in self.RIGHT_EYE:
-                    cv2.circle(frame, tuple(landmarks_np[idx]), 1, color_drowsy, -1)
-                # Draw Mouth 
-                for idx in self.MOUTH:
-                    cv2.circle(frame, tuple(landmarks_np[idx]), 2, color_yawn, -1)
-
-            # Show Info on video
-            if config.SHOW_EAR_MAR:
-                cv2.putText(frame, f"EAR: {ear:.2f}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                cv2.putText(frame, f"MAR: {mar:.2f}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                cv2.putText(frame, f"Score: {self.drowsiness_score:.1f}", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-            if is_drowsy:
-                cv2.putText(frame, "DROWSINESS!", (10, 130), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-            if is_yawning:
-                cv2.putText(frame, "YAWN!", (10, 150), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 255), 2)
+            # --- DRAWING --- (skipped when nobody looks at the frame)
+            if self.draw:
+                self._draw_overlay(frame, landmarks_np, ear, mar, is_drowsy, is_yawning)
         else:
             # No face detected
             self.face_lost_counter += 1
@@ -321,31 +463,94 @@ class DrowsinessAnalyzer:
             if self.face_lost_counter > self.face_lost_threshold:
                 #face_detected = False
                 self.face_lost_counter = 0
-                # Disegno l'alert sul frame solo dopo il ritardo
-                text = "!!! FACE LOST !!!"
-                font = cv2.FONT_HERSHEY_SIMPLEX
-                scale = 1.2
-                thickness = 3
-                # Calcola la posizione centrale
-                (text_w, text_h), baseline = cv2.getTextSize(text, font, scale, thickness)
-
-                x = (w - text_w) // 2
-                y = (h + text_h) // 2  
-
-                cv2.putText(frame, text, (x, y),
-                            font, scale, (0, 0, 255), thickness)
+                if self.draw:
+                    # Disegno l'alert sul frame solo dopo il ritardo
+                    # (maschera del testo in cache, posizione centrale ricalcolata solo se cambia la size)
+                    if self._face_lost_size != (w, h):
+                        (text_w, text_h), _ = cv2.getTextSize(FACE_LOST_TEXT, cv2.FONT_HERSHEY_SIMPLEX, 1.2, 3)
+                        self._face_lost_size = (w, h)
+                        self._face_lost_org = ((w - text_w) // 2, (h + text_h) // 2)
+                    self._blit_label(frame, FACE_LOST_TEXT, self._face_lost_org, 1.2, self._RED, 3)
             #else:
                 #face_detected = True
             
+        self._last_outcome = (ear, mar, is_drowsy, is_yawning, face_detected)
         return frame, ear, mar, is_drowsy, is_yawning, face_detected, self.drowsiness_score
 
+    def _blit_label(self, frame, text, org, scale, color, thickness=2):
+        """
+        Same pixels as cv2.putText(frame, text, org, FONT_HERSHEY_SIMPLEX, scale, color, thickness),
+        but the glyphs are rasterized once per string into a cached mask and then just copied
+        """
+        key = (text, scale, thickness)
+        cache = self._text_cache
+        entry = cache.get(key)
+        if entry is None:
+            (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+            pad = thickness + 1  # Stroke width spills a bit outside the nominal text box
+            mask = np.zeros((text_h + baseline + 2 * pad, text_w + 2 * pad), dtype=np.uint8)
+            cv2.putText(mask, text, (pad, text_h + pad), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, thickness)
+            entry = (mask.astype(bool), pad, text_h + pad)  # Mask + offset of org inside it
+            cache[key] = entry
+            if len(cache) > TEXT_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+
+        mask, dx, dy = entry
+        x0, y0 = org[0] - dx, org[1] - dy
+        mask_h, mask_w = mask.shape
+        h, w = frame.shape[:2]
+        # Clip to the frame like putText does
+        fx0, fy0 = max(x0, 0), max(y0, 0)
+        fx1, fy1 = min(x0 + mask_w, w), min(y0 + mask_h, h)
+        if fx0 >= fx1 or fy0 >= fy1:
+            return
+        frame[fy0:fy1, fx0:fx1][mask[fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0]] = color
+
+    def _draw_overlay(self, frame, landmarks_np, ear, mar, is_drowsy, is_yawning):
+        """Eye/mouth contours, EAR/MAR/Score values and alerts"""
+        if self._show_landmarks:
+            color_drowsy = self._RED if is_drowsy else self._GREEN
+            color_yawn = self._RED if is_yawning else self._YELLOW
+            pts_px = self._pts_px
+            np.copyto(pts_px, landmarks_np, casting='unsafe')  # Truncates like int()
+
+            # Draw Eyes (both contours in one call; the 6 EAR points are already in contour order)
+            cv2.polylines(frame, [pts_px[:6], pts_px[6:12]], True, color_drowsy, 1)
+            # Draw Mouth 
+            cv2.polylines(frame, [pts_px[self._MOUTH_CONTOUR]], True, color_yawn, 1)
+
+        # Show Info on video
+        if self._show_ear_mar:
+            self._blit_label(frame, f"EAR: {ear:.2f}", (10, 30), 0.6, self._GREEN)
+            self._blit_label(frame, f"MAR: {mar:.2f}", (10, 60), 0.6, self._GREEN)
+            self._blit_label(frame, f"Score: {self.drowsiness_score:.1f}", (10, 90), 0.6, self._GREEN)
+        if is_drowsy:
+            self._blit_label(frame, "DROWSINESS!", (10, 130), 0.8, self._RED)
+        if is_yawning:
+            self._blit_label(frame, "YAWN!", (10, 150), 0.8, self._YELLOW)
+
     def _log_event(self, event_type):
-        if not config.LOG_EVENTS: return
+        if self._log_q is None: return
         try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with open(config.LOG_FILE, "a") as f:
-                f.write(f"[{timestamp}] {event_type}\n")
-        except Exception: pass
+            self._log_q.put_nowait((datetime.now().strftime("%Y-%m-%d %H:%M:%S"), event_type))
+        except queue.Full: pass  # Writer stuck on I/O: drop the event rather than block detect()
+
+    def _log_worker(self):
+        """Appends queued events to config.LOG_FILE, file opened once, flushed when the queue drains"""
+        log_q = self._log_q
+        while True:
+            try:
+                with open(config.LOG_FILE, "a") as f:
+                    while True:
+                        timestamp, event_type = log_q.get()
+                        f.write(f"[{timestamp}] {event_type}\n")
+                        if log_q.empty():
+                            f.flush()
+            except Exception as e:
+                print(f"[WARN] Event log: {e}")
+                time.sleep(1.0)
 
     def get_statistics(self):
         return {
@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+"""
+streaming.py - Frame streaming helpers for the Raspberry Pi clients
+Shared module used by the Raspberry Pi clients to send frames to the PC Server.
+JPEG encoding uses libjpeg-turbo (PyTurboJPEG) when available, OpenCV otherwise.
+On the Pi camera the hardware H.264 encoder can be used instead of JPEG.
+"""
+
+import io
+import os
+import sys
+import errno
+import queue
+import select
+import socket
+import struct
+import threading
+from collections import deque
+import cv2
+import numpy as np
+
+# Import config from the same 'shared' folder
+try:
+    from . import config  # When imported as a package
+except ImportError:
+    import config  # When executed directly
+
+# libjpeg-turbo bindings (NEON SIMD on ARM), optional
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    HAS_TURBOJPEG = True
+except ImportError:
+    HAS_TURBOJPEG = False
+
+# Frame protocol: [4 bytes stats_size][JSON stats][1 byte frame_type][4 bytes frame_size][frame]
+STATS_HDR = struct.Struct('>I')
+FRAME_HDR = struct.Struct('>BI')
+
+# Frame types
+FRAME_JPEG = 0   # One complete JPEG image
+FRAME_H264 = 1   # One H.264 access unit (Annex-B, start codes included)
+FRAME_REPEAT = 2 # No payload: near-duplicate frame, the server analyzes the previous JPEG again
+
+# Linux MSG_ZEROCOPY (not exported by the socket module)
+SO_ZEROCOPY = getattr(socket, 'SO_ZEROCOPY', 60)
+MSG_ZEROCOPY = getattr(socket, 'MSG_ZEROCOPY', 0x4000000)
+SO_EE_ORIGIN_ZEROCOPY = 5
+# struct sock_extended_err: errno, origin, type, code, pad, info (first id), data (last id)
+_SOCK_EXTENDED_ERR = struct.Struct('=IBBBBII')
+ZEROCOPY_MIN_SIZE = 10 * 1024  # Below this, page pinning costs more than the copy
+
+
+class JpegEncoder:
+    """
+    JPEG encoder based on libjpeg-turbo, with OpenCV fallback.
+    With libjpeg-turbo the output goes into a ring of preallocated buffers: a returned JPEG
+    stays valid for the next ring_size - 1 encodes (encoder thread + out_q + sender = 3).
+    MSG_ZEROCOPY keeps buffers referenced until the kernel is done, so it disables the ring.
+    """
+
+    def __init__(self, quality=config.JPEG_QUALITY, ring_size=4):
+        self.quality = quality
+        self._cv_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self._tj = None
+        self._ring_size = 0 if config.ZEROCOPY_SEND else ring_size
+        self._ring = []
+        self._ring_next = 0
+        # The main loop may encode the first frame after connecting while the encode thread runs
+        self._lock = threading.Lock()
+
+        if HAS_TURBOJPEG:
+            try:
+                self._tj = TurboJPEG()
+                print("[INFO] JPEG encoder: libjpeg-turbo")
+            except Exception as e:
+                # Python bindings installed but libturbojpeg.so not found
+                print(f"[WARN] TurboJPEG not available ({e}), using OpenCV encoder")
+
+    def encode(self, frame):
+        """Encodes a BGR frame and returns the JPEG data (bytes-like, ready for sendmsg)"""
+        with self._lock:
+            return self._encode(frame)
+
+    def _encode(self, frame):
+        if self._tj is not None:
+            if self._ring_size:
+                try:
+                    buf = self._next_buffer(frame)
+                    _, size = self._tj.encode(frame, quality=self.quality, pixel_format=TJPF_BGR,
+                                              jpeg_subsample=TJSAMP_420, dst=buf)
+                    return memoryview(buf)[:size]
+                except (TypeError, AttributeError):
+                    # PyTurboJPEG < 1.7.2 has no dst argument/buffer_size()
+                    self._ring_size = 0
+            # 4:2:0 subsampling (same as OpenCV default), halves chroma work
+            return self._tj.encode(frame, quality=self.quality,
+                                   pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+        _, encoded = cv2.imencode('.jpg', frame, self._cv_params)
+        # Flat view over the encoder's buffer: no tobytes() copy before the socket
+        return memoryview(encoded).cast('B')
+
+    def _next_buffer(self, frame):
+        """Next ring buffer, (re)allocated at the worst-case JPEG size for this frame size"""
+        size = self._tj.buffer_size(frame, jpeg_subsample=TJSAMP_420)
+        if len(self._ring) != self._ring_size or len(self._ring[0]) != size:
+            self._ring = [bytearray(size) for _ in range(self._ring_size)]
+        buf = self._ring[self._ring_next]
+        self._ring_next = (self._ring_next + 1) % self._ring_size
+        return buf
+
+
+class DuplicateFrameFilter:
+    """
+    Detects near-duplicate frames with an 8x8 average hash (aHash).
+    A frame is a duplicate when its hash differs from the last *sent* frame by fewer than
+    max_distance bits; at least one frame every force_every is reported as new.
+    Thread-safe: the encoder thread and the main loop (inline encode) share one filter.
+    Call reset() on every new connection, the server has no previous frame to repeat.
+    """
+
+    def __init__(self, max_distance=config.DUPLICATE_HASH_DISTANCE, force_every=config.FORCE_SEND_EVERY):
+        self.max_distance = max_distance
+        self.force_every = force_every
+        self._last_hash = None
+        self._skipped = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """The next frame is always reported as new"""
+        with self._lock:
+            self._last_hash = None
+            self._skipped = 0
+
+    def is_duplicate(self, frame):
+        small = cv2.resize(frame, (8, 8), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        frame_hash = int.from_bytes(np.packbits(gray > gray.mean()).tobytes(), 'big')
+        with self._lock:
+            if (self._last_hash is not None and self._skipped < self.force_every - 1
+                    and bin(frame_hash ^ self._last_hash).count('1') < self.max_distance):
+                self._skipped += 1
+                return True
+            self._last_hash = frame_hash
+            self._skipped = 0
+            return False
+
+
+def pin_thread(cpu, rt_priority=0):
+    """
+    Pins the calling thread to one core and optionally gives it SCHED_FIFO priority.
+    Best effort: silently does nothing where unsupported (cpu missing, non-Linux, no privileges).
+    """
+    if cpu is not None and hasattr(os, 'sched_setaffinity') and cpu < (os.cpu_count() or 1):
+        try:
+            os.sched_setaffinity(0, {cpu})  # pid 0 = calling thread
+        except OSError:
+            pass
+    if rt_priority and hasattr(os, 'sched_setscheduler'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(rt_priority))
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Real-time priority not available ({e})")
+
+
+def start_connect(address):
+    """Starts a non-blocking TCP connect, returns the socket with the connection in progress"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+        sock.close()
+        raise OSError(err, os.strerror(err))
+    return sock
+
+
+def poll_connect(sock):
+    """
+    Checks a connect started with start_connect() without blocking.
+    Returns True once connected (socket switched back to blocking), False while still in
+    progress. Raises OSError if the connection failed.
+    """
+    _, writable, _ = select.select([], [sock], [], 0)
+    if not writable:
+        return False
+    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(err, os.strerror(err))
+    sock.setblocking(True)
+    return True
+
+
+class FrameSender:
+    """
+    Sends frames to the PC Server over a connected TCP socket.
+    Protocol: [4 bytes stats_size][JSON stats][1 byte frame_type][4 bytes frame_size][frame]
+    The whole packet goes out with a single scatter-gather sendmsg (no concatenation copies).
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Ship every frame immediately (no Nagle/delayed-ACK stalls)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.SEND_BUFFER_SIZE)
+        self._enable_keepalive(sock)
+        self._use_sendmsg = hasattr(sock, 'sendmsg')  # Not available on Windows
+        # Without sendmsg the packet is assembled here (grown on demand, never per frame)
+        self._send_buf = bytearray(0 if self._use_sendmsg else 128 * 1024)
+        # Reused header buffer: [stats_size][frame_type, frame_size], no per-frame allocations
+        self._hdr_buf = bytearray(STATS_HDR.size + FRAME_HDR.size)
+        hdr_view = memoryview(self._hdr_buf)
+        self._stats_hdr = hdr_view[:STATS_HDR.size]
+        self._frame_hdr = hdr_view[STATS_HDR.size:]
+
+        # Optional MSG_ZEROCOPY: the kernel sends straight from our buffers
+        self._zerocopy = False
+        self._zc_sent = 0          # Zerocopy sendmsg calls so far (the kernel numbers them from 0)
+        self._zc_pending = deque() # (last call id, buffers) kept alive until the kernel is done
+        if config.ZEROCOPY_SEND and sys.platform.startswith('linux') and self._use_sendmsg:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+                self._zerocopy = True
+            except OSError as e:
+                print(f"[WARN] MSG_ZEROCOPY not supported ({e}), using regular sends")
+
+    @staticmethod
+    def _enable_keepalive(sock):
+        """Lets the kernel detect a dead server in a few seconds (options missing on some OSes are skipped)"""
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', config.KEEPALIVE_IDLE),
+                            ('TCP_KEEPINTVL', config.KEEPALIVE_INTERVAL),
+                            ('TCP_KEEPCNT', config.KEEPALIVE_COUNT),
+                            ('TCP_USER_TIMEOUT', config.TCP_USER_TIMEOUT_MS)):
+            if hasattr(socket, name):
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+                except OSError:
+                    pass
+
+    def send(self, stats_json, frame_data, frame_type=FRAME_JPEG):
+        STATS_HDR.pack_into(self._hdr_buf, 0, len(stats_json))
+        FRAME_HDR.pack_into(self._hdr_buf, STATS_HDR.size, frame_type, len(frame_data))
+        if self._zerocopy and len(frame_data) >= ZEROCOPY_MIN_SIZE:
+            self._send_zerocopy(stats_json, frame_data)
+            return
+        buffers = [self._stats_hdr, stats_json, self._frame_hdr, frame_data]
+        if not self._use_sendmsg:
+            self.sock.sendall(self._pack(buffers))
+            return
+        self._sendmsg_all(buffers)
+
+    def _pack(self, buffers):
+        """Copies the packet parts into the reused send buffer, returns a view of the packet"""
+        total = sum(len(b) for b in buffers)
+        if total > len(self._send_buf):
+            self._send_buf = bytearray(max(total, 2 * len(self._send_buf)))
+        view = memoryview(self._send_buf)
+        pos = 0
+        for b in buffers:
+            view[pos:pos + len(b)] = b
+            pos += len(b)
+        return view[:total]
+
+    def _sendmsg_all(self, buffers, flags=0):
+        """sendmsg until everything is out, returns the number of sendmsg calls"""
+        calls = 0
+        while buffers:
+            sent = self.sock.sendmsg(buffers, [], flags)
+            calls += 1
+            # Partial send (rare on blocking sockets): drop sent buffers, trim the current one
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers and sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        return calls
+
+    def _send_zerocopy(self, stats_json, frame_data):
+        self._reap_zerocopy()
+        # The kernel reads the buffers after sendmsg returns: copy the (reused) headers
+        # and keep every buffer alive until its completion notification arrives
+        buffers = [bytes(self._stats_hdr), stats_json, bytes(self._frame_hdr), frame_data]
+        self._zc_sent += self._sendmsg_all(list(buffers), MSG_ZEROCOPY)
+        self._zc_pending.append((self._zc_sent - 1, buffers))
+
+    def _reap_zerocopy(self):
+        """Reads zerocopy completions from the socket error queue (non-blocking)"""
+        while self._zc_pending:
+            try:
+                _, ancdata, _, _ = self.sock.recvmsg(0, 256, socket.MSG_ERRQUEUE | socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            for _, _, cdata in ancdata:
+                if len(cdata) < _SOCK_EXTENDED_ERR.size:
+                    continue
+                _, origin, _, _, _, _, last_id = _SOCK_EXTENDED_ERR.unpack_from(cdata)
+                if origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                while self._zc_pending and self._zc_pending[0][0] <= last_id:
+                    self._zc_pending.popleft()
+
+
+def _is_h264_keyframe(data):
+    """True if the access unit contains an SPS or IDR NAL unit (start-code scan)"""
+    i = data.find(b'\x00\x00\x01')
+    while i != -1 and i + 3 < len(data):
+        if data[i + 3] & 0x1F in (5, 7):  # 5 = IDR slice, 7 = SPS
+            return True
+        i = data.find(b'\x00\x00\x01', i + 3)
+    return False
+
+
+class H264Stream(io.BufferedIOBase):
+    """
+    File-like sink for the Picamera2 hardware H.264 encoder (V4L2 M2M on VideoCore).
+    Each write() is one encoded access unit, queued for the sender.
+    Output is dropped while inactive (not connected). Every change of `active` empties the
+    queue, so nothing encoded before a disconnect is sent after the reconnect, and the
+    stream restarts at the next keyframe so the server decoder can always sync.
+    """
+
+    frame_type = FRAME_H264
+
+    def __init__(self, maxsize=30):
+        self.q = queue.Queue(maxsize=maxsize)
+        self._active = False
+        self._synced = False
+        self._lock = threading.Lock()  # Encoder thread (write) vs main loop (active)
+
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, value):
+        with self._lock:
+            if value == self._active:
+                return
+            self._active = value
+            self._synced = False  # Only accept frames again from the next keyframe
+            self.drain()
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        n = len(buf)
+        if not self._active:
+            return n
+        data = bytes(buf)
+        with self._lock:
+            if not self._active:
+                return n
+            if not self._synced:
+                if not self._is_keyframe(data):
+                    return n
+                self._synced = True
+            try:
+                self.q.put_nowait(data)
+            except queue.Full:
+                # Sender too slow: P-frames can't be skipped, wait for the next keyframe
+                self._synced = False
+        return n
+
+    def _is_keyframe(self, data):
+        return _is_h264_keyframe(data)
+
+    def drain(self):
+        """Returns all queued access units (oldest first)"""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.q.get_nowait())
+            except queue.Empty:
+                return chunks
+
+
+def start_h264_encoder(camera):
+    """Starts the Picamera2 hardware H.264 encoder, returns the H264Stream it writes to"""
+    from picamera2.encoders import H264Encoder
+    from picamera2.outputs import FileOutput
+
+    stream = H264Stream()
+    # repeat=True: SPS/PPS before every IDR, one IDR per second to (re)sync the server
+    encoder = H264Encoder(bitrate=config.H264_BITRATE, repeat=True, iperiod=config.CAMERA_FPS)
+    camera.start_encoder(encoder, FileOutput(stream))
+    return stream
+
+
+class MjpegStream(H264Stream):
+    """
+    Sink for the Picamera2 hardware MJPEG encoder: each write() is a complete JPEG,
+    sent as FRAME_JPEG (the server needs nothing new). Every frame is a keyframe.
+    """
+
+    frame_type = FRAME_JPEG
+
+    def _is_keyframe(self, data):
+        return True
+
+
+def start_mjpeg_encoder(camera):
+    """Starts the Picamera2 hardware MJPEG encoder, returns the MjpegStream it writes to"""
+    from picamera2.encoders import MJPEGEncoder
+    from picamera2.outputs import FileOutput
+
+    stream = MjpegStream()
+    camera.start_encoder(MJPEGEncoder(bitrate=config.MJPEG_BITRATE), FileOutput(stream))
+    return stream
+
+
+def start_hw_encoder(camera, codec):
+    """Starts the hardware encoder for codec ("h264" or "mjpeg"), None for software JPEG"""
+    if codec == "h264":
+        return start_h264_encoder(camera)
+    if codec == "mjpeg":
+        return start_mjpeg_encoder(camera)
+    return None
+
+
+class CameraFrameRing:
+    """
+    Picamera2 capture into a ring of preallocated frames.
+    capture_array() allocates a new array every frame; here the DMA buffer of each request is
+    mapped (MappedArray, no copy) and copied once into a free ring slot, then released to
+    the camera right away. A slot is reused only after its frame is handed back with
+    release(): capture never waits for the consumers, so when every slot is still held it
+    falls back to a newly allocated copy instead of overwriting a frame in use.
+    """
+
+    def __init__(self, camera, size=6, stream="main"):
+        from picamera2 import MappedArray
+        self._mapped_array = MappedArray
+        self.camera = camera
+        self.size = size
+        self.stream = stream
+        self._frames = None
+        self._free = deque()  # Slot views ready to be filled
+        self._held = {}       # id(slot view) -> view, for frames out of the ring
+        self._lock = threading.Lock()  # capture thread vs consumer threads
+
+    def capture(self):
+        request = self.camera.capture_request()
+        try:
+            with self._mapped_array(request, self.stream) as m:
+                src = m.array
+                with self._lock:
+                    if self._frames is None or self._frames.shape[1:] != src.shape:
+                        # Frames still held from the old size are simply not taken back
+                        self._frames = np.empty((self.size,) + src.shape, dtype=src.dtype)
+                        self._free = deque(self._frames[i] for i in range(self.size))
+                        self._held = {}
+                    frame = self._free.popleft() if self._free else None
+                    if frame is not None:
+                        self._held[id(frame)] = frame
+                if frame is None:
+                    frame = src.copy()  # Every slot still in use
+                else:
+                    np.copyto(frame, src)
+        finally:
+            request.release()
+        return frame
+
+    def release(self, frame):
+        """Hands a frame from capture() back to the ring (fallback copies and repeats are ignored)"""
+        with self._lock:
+            if self._held.pop(id(frame), None) is frame:
+                self._free.append(frame)
+
+
+class FramePipeline:
+    """
+    Capture -> encode pipeline running on two background threads.
+    capture thread: capture() -> raw_q
+    encode thread:  raw_q -> (frame, jpeg) -> out_q (jpeg is None when should_encode() is False)
+    raw_q keeps only the latest frame: when the encoder/consumer falls behind, the stale
+    frame is dropped and the camera keeps running at its own rate. Encoded frames go through
+    out_q blocking, so every one reaches the sender (FRAME_REPEAT needs its predecessor);
+    unencoded ones (standalone detection) replace the stale one, so the consumer always
+    gets the newest frame.
+    The consumer (main thread) sends the JPEG or runs the local analyzer on the frame.
+    Each thread pins itself to its core (config.CAPTURE_CPU / ENCODE_CPU by default).
+    release(frame) is called for every frame the pipeline drops (e.g. CameraFrameRing.release);
+    the consumer calls it itself once done with a frame from get().
+    An exception in capture() or encode() stops the pipeline and is re-raised by get().
+    """
+
+    def __init__(self, capture, encode, should_encode, maxsize=1,
+                 capture_cpu=config.CAPTURE_CPU, encode_cpu=config.ENCODE_CPU, release=None):
+        self.capture = capture
+        self.encode = encode
+        self.should_encode = should_encode
+        self.release = release or (lambda frame: None)
+        self.capture_cpu = capture_cpu
+        self.encode_cpu = encode_cpu
+        self.raw_q = queue.Queue(maxsize=maxsize)
+        self.out_q = queue.Queue(maxsize=maxsize)
+        self.running = False
+        self._threads = []
+        self._error = None  # First exception raised by a stage thread
+
+    def start(self):
+        self.running = True
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name="capture", daemon=True),
+            threading.Thread(target=self._encode_loop, name="encode", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self.running = False
+        for t in self._threads:
+            t.join(timeout=1.0)
+
+    def get(self, timeout=1.0):
+        """Returns the next (frame, jpeg) pair, (None, None) on timeout. Raises a stage's exception"""
+        if self._error is not None:
+            raise self._error
+        try:
+            return self.out_q.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    def _fail(self, stage, error):
+        # A dead stage would leave get() returning (None, None) forever: stop and report it
+        print(f"[ERROR] {stage} failed: {error}")
+        if self._error is None:
+            self._error = error
+        self.running = False
+
+    def _put(self, q, item):
+        # Blocking put that still notices stop()
+        while self.running:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _put_latest(self, q, item):
+        # Non-blocking put that replaces the oldest item (single producer per queue).
+        # Returns the replaced item (None if the consumer took it first)
+        try:
+            q.put_nowait(item)
+            return None
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+            except queue.Empty:
+                dropped = None
+            q.put_nowait(item)
+            return dropped
+
+    def _capture_loop(self):
+        pin_thread(self.capture_cpu)
+        try:
+            while self.running:
+                frame = self.capture()
+                if frame is not None:
+                    dropped = self._put_latest(self.raw_q, frame)
+                    if dropped is not None:
+                        self.release(dropped)
+        except Exception as e:
+            self._fail("Capture", e)
+
+    def _encode_loop(self):
+        pin_thread(self.encode_cpu)
+        try:
+            while self.running:
+                try:
+                    frame = self.raw_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if self.should_encode():
+                    self._put(self.out_q, (frame, self.encode(frame)))
+                else:
+                    dropped = self._put_latest(self.out_q, (frame, None))
+                    if dropped is not None:
+                        self.release(dropped[0])
+        except Exception as e:
+            self._fail("Encoding", e)